@@ -0,0 +1,267 @@
+__author__ = 'Wombat'
+
+from multiprocessing import Pipe, Process, cpu_count
+from pickle import dump
+import numpy as np
+import Chris_ModelFile
+from Chris_FastHMM import load_compiled_model
+from FastA_V2 import AnnotatedFastA
+
+
+def expected_counts(model, shard):
+
+    """The E-step for one shard of records. shard is a list of (sequence, labels) pairs, where labels is either None
+    (an unlabeled record, whose counts are the posterior expectations from forward / backward) or a state string of
+    the same length as the sequence (a labeled record, whose counts are simply the observed ones). Labels may also be
+    given as a list of state names or an array of state indices, for models whose state names are not single letters.
+
+    Returns (transition_counts, emission_counts, log_likelihood) summed over the whole shard. This is a plain module
+    level function so that it can be shipped to the worker processes of a multiprocessing Pool.
+    """
+
+    number_of_states = len(model.states)
+    number_of_symbols = model.log_emissions.shape[1]
+    transition_counts = np.zeros((number_of_states, number_of_states))
+    emission_counts = np.zeros((number_of_states, number_of_symbols))
+    total_log_likelihood = 0
+
+    for sequence, labels in shard:
+        encoded = model.encode(sequence)
+        if len(encoded) < 2:
+            continue
+
+        if labels is not None and len(labels):
+            path = model.encode_path(labels.upper() if isinstance(labels, str) else labels)
+            np.add.at(transition_counts, (path[:-1], path[1:]), 1)
+            np.add.at(emission_counts, (path[1:], encoded[1:]), 1)     # the start column emits nothing
+            total_log_likelihood += model.log_transitions[path[:-1], path[1:]].sum() + \
+                model.log_emissions[path[1:], encoded[1:]].sum()
+            continue
+
+        log_likelihood, log_alpha = model.forward(sequence)
+        if log_likelihood == -np.inf:        # this model cannot produce the record at all, so it tells us nothing
+            continue
+        log_beta = model.backward(sequence)[1]
+        emission_columns = model.log_emissions[:, encoded].T
+
+        # xi[t, e]: probability of taking edge e (state k at t-1, state l at t) given the whole sequence. Impossible
+        # transitions would only ever contribute zeros, so only the model's edges are computed, not every (k, l) pair
+        xi = np.exp(log_alpha[:-1, model.edge_sources] + model.edge_log_transitions +
+                    (emission_columns[1:] + log_beta[1:])[:, model.edge_destinations] - log_likelihood)
+        transition_counts[model.edge_sources, model.edge_destinations] += xi.sum(axis=0)
+
+        # gamma[t, l]: probability of being in state l at t, given the whole sequence
+        gamma = np.exp(log_alpha + log_beta - log_likelihood)
+        for state in range(number_of_states):
+            emission_counts[state] += np.bincount(encoded[1:], weights=gamma[1:, state], minlength=number_of_symbols)
+
+        total_log_likelihood += log_likelihood
+
+    return transition_counts, emission_counts, total_log_likelihood
+
+
+def _worker(connection, shards):
+
+    """A training worker process. It is started with its own shards only, keeps them for the whole run, and for every
+    model it is sent back over connection returns the (transition_counts, emission_counts, log_likelihood) summed over
+    them, until it is sent None.
+    """
+
+    while True:
+        model = connection.recv()
+        if model is None:
+            break
+        results = [expected_counts(model, shard) for shard in shards] or [expected_counts(model, [])]
+        connection.send(tuple(sum(result[i] for result in results) for i in range(3)))
+    connection.close()
+
+
+class BaumWelch(object):
+    """BaumWelch
+    Unsupervised / semi-supervised re-estimation of the transitions and emissions of a CompiledHMM.
+
+    Each iteration's E-step is sharded across worker processes: the records are cut into shards of roughly equal total
+    length and dealt out among the workers, every worker computes the expected transition and emission counts for its
+    own shards, and the per-worker count matrices are summed into a single pair of matrices. A worker is handed its
+    shards once, when it starts, and holds no one else's, so the records are in memory once across all of the workers
+    (besides the caller's own copy), and from then on an iteration only sends out the model's tables and gets back
+    count matrices, whatever the size of the training set. The M-step then normalizes those counts back into
+    probabilities.
+
+    Records that come with a '#' topology are counted directly from their labels (the semi-supervised part); those
+    without are counted from their forward / backward posteriors.
+
+    Only transitions and emissions that are possible in the starting model are ever re-estimated, so the topology of
+    the model (e.g. I never goes straight to O) is preserved, and a state whose row collects no counts at all (like
+    the start state's emissions) keeps its starting values.
+
+    tied_emissions optionally gives a group number for every state; states in the same group pool their emission
+    counts and so always share one emission distribution (e.g. all the k-mer states of an order-k model that end in M,
+    see Chris_HigherOrderHMM).
+    """
+
+    def __init__(self, model, processes=None, pseudocount=0.01, shards_per_process=4, tied_emissions=None):
+
+        self.model = model
+        self.processes = processes or cpu_count()
+        self.pseudocount = pseudocount      # added to every allowed transition / emission so nothing collapses to zero
+        self.shards_per_process = shards_per_process
+        self.tied_emissions = None if tied_emissions is None else np.asarray(tied_emissions)
+        self.log_likelihoods = []           # the total log likelihood of the training data at each iteration
+
+    def train(self, records, tolerance=1e-6, max_iterations=100):
+
+        """Re-estimate the model on records, a list of (sequence, labels) pairs (labels may be None), until the relative
+        improvement in total log likelihood drops below tolerance or max_iterations have been run. Returns the trained
+        CompiledHMM, which is also left in self.model.
+        """
+
+        shards = self._make_shards(records, self.processes * self.shards_per_process)
+        workers = self._start_workers(shards)
+
+        try:
+            for iteration in range(max_iterations):
+                transition_counts, emission_counts, log_likelihood = self._e_step(workers)
+                self.model = self._m_step(transition_counts, emission_counts)
+                self.log_likelihoods.append(log_likelihood)
+                print('Iteration', iteration + 1, 'log likelihood', log_likelihood)
+
+                if len(self.log_likelihoods) > 1:
+                    improvement = self.log_likelihoods[-1] - self.log_likelihoods[-2]
+                    if improvement < tolerance * abs(self.log_likelihoods[-2]):
+                        break
+        finally:
+            self._stop_workers(workers)
+
+        return self.model
+
+    def estimate_from_labels(self, records):
+
+        """Estimate the model directly from labeled records, a list of (sequence, labels) pairs: the observed counts are
+        normalized within the topology of self.model (with the pseudocount and any tied emissions), in one step and in
+        this process, with no workers and no iteration. Returns the estimated CompiledHMM, which is also left in
+        self.model.
+        """
+
+        transition_counts, emission_counts = expected_counts(self.model, records)[:2]
+        self.model = self._m_step(transition_counts, emission_counts)
+        return self.model
+
+    def _start_workers(self, shards):
+
+        """Start up to self.processes workers, dealing the shards out among them (the shards come longest first, so
+        dealing them round robin keeps the workers' totals close). Returns a list of (connection, process) pairs.
+        """
+
+        workers = []
+        for number in range(min(self.processes, len(shards))):
+            connection, worker_connection = Pipe()
+            process = Process(target=_worker, args=(worker_connection, shards[number::self.processes]), daemon=True)
+            process.start()
+            worker_connection.close()       # the worker's end, which only the worker needs
+            workers.append((connection, process))
+        return workers
+
+    @staticmethod
+    def _stop_workers(workers):
+
+        for connection, process in workers:
+            try:
+                connection.send(None)
+            except OSError:         # the worker has already gone
+                pass
+            connection.close()
+        for connection, process in workers:
+            process.join()
+
+    def _e_step(self, workers):
+
+        """Send the current model to every worker (they already hold their shards) and reduce their counts into one
+        set of count matrices
+        """
+
+        for connection, process in workers:
+            connection.send(self.model)
+        results = [connection.recv() for connection, process in workers]
+        transition_counts = sum(result[0] for result in results)
+        emission_counts = sum(result[1] for result in results)
+        log_likelihood = sum(result[2] for result in results)
+        return transition_counts, emission_counts, log_likelihood
+
+    def _m_step(self, transition_counts, emission_counts):
+
+        """Turn expected counts back into a model, keeping impossible entries impossible"""
+
+        if self.tied_emissions is not None:      # pool each group's counts, and give every member the pooled total
+            group_counts = np.zeros((self.tied_emissions.max() + 1, emission_counts.shape[1]))
+            np.add.at(group_counts, self.tied_emissions, emission_counts)
+            emission_counts = group_counts[self.tied_emissions]
+
+        log_transitions = self._normalize(transition_counts, self.model.log_transitions)
+        # The unknown-symbol column is not a real emission: leave it out here, with_tables recomputes it from the rest
+        log_emissions = self._normalize(emission_counts[:, :-1], self.model.log_emissions[:, :-1])
+        return self.model.with_tables(log_transitions, np.hstack((log_emissions, self.model.log_emissions[:, -1:])))
+
+    def _normalize(self, counts, log_table):
+
+        allowed = log_table > -np.inf
+        observed = np.where(allowed, counts, 0).sum(axis=1) > 0
+        counts = np.where(allowed, counts + self.pseudocount, 0)
+        totals = counts.sum(axis=1, keepdims=True)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            new_table = np.log(counts / totals)
+        return np.where(observed[:, np.newaxis], new_table, log_table)  # rows with no data keep their old values
+
+    @staticmethod
+    def _make_shards(records, number_of_shards):
+
+        """Deal the records out into shards of roughly equal total sequence length, longest records first"""
+
+        shards = [[] for _ in range(max(1, min(number_of_shards, len(records))))]
+        sizes = [0] * len(shards)
+
+        for record in sorted(records, key=lambda r: len(r[0]), reverse=True):
+            smallest = sizes.index(min(sizes))
+            shards[smallest].append(record)
+            sizes[smallest] += len(record[0])
+
+        return shards
+
+    def save_model(self, file_path, artifact_path=None):
+
+        """Pickle the trained transitions in the same dict-of-dicts format Hamlet.save_model writes, so HMM can load it,
+        and write the whole trained model, re-estimated emissions included, as a binary model artifact (by default
+        file_path + '.tmm', see Chris_ModelFile), which load_compiled_model can load in place of the pickle. There is
+        no default file_path, so that the acid_dict the decoders load is never overwritten by accident.
+        """
+
+        transitions, emissions = self.model.to_dicts()
+        with open(file_path, 'wb') as f:
+            dump(transitions, f)
+        print("We have pickled the dict to file", file_path)
+        Chris_ModelFile.save_model_artifact(self.model, artifact_path or file_path + Chris_ModelFile.SUFFIX)
+        return transitions, emissions
+
+
+def main():
+
+    """Semi-supervised retraining on the membrane protein set: the records used for the Hamlet transition counts keep
+    their labels, and the ECOLI records (which the Chris_MiniHMM.py driver decodes) are treated as unlabeled.
+    """
+
+    records = []
+    for annotation, acid, labels in AnnotatedFastA("160_membrane_prots.txt"):
+        labels = None if 'ECOLI' in annotation or labels is None else 'S' + labels
+        records.append(("_" + acid, labels))
+
+    starting_model = load_compiled_model()      # the acid_dict transitions and TMM_HMM_dicts emissions
+    trainer = BaumWelch(starting_model)
+    trainer.train(records, max_iterations=20)
+    transitions, emissions = trainer.model.to_dicts()
+    print(transitions)
+    print(emissions)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,161 @@
+"""Chris_BinaryFormat
+The container layout shared by the binary file formats (Chris_ModelFile's .tmm models, Chris_TopologyStore's .topo
+stores and Chris_Corpus's .corpus files):
+
+    magic       8 bytes     identifies the format
+    version     uint32      little-endian
+    header_len  uint32      little-endian, length in bytes of the JSON header that follows
+    header      JSON        whatever the format needs, plus {'offset': ..., 'shape': ...} for each of its arrays
+    padding                 zero bytes up to the next multiple of 64
+    arrays                  each aligned to 64 bytes, at offsets relative to the start of the array section
+
+so that every array can be memory-mapped in place. Files are written under a temporary name and renamed into place,
+so a reader never sees half of one, and everything read back is checked against the actual file size before it is
+mapped: a truncated or corrupt file raises the format's own error (a ValueError) rather than struct.error or a mmap
+failure.
+"""
+
+__author__ = 'Wombat'
+
+import json
+import os
+import struct
+import numpy as np
+
+ALIGNMENT = 64
+
+
+class BinaryFormatError(ValueError):
+
+    """Raised when a binary file is malformed, truncated or of an unknown version"""
+
+
+def padding(length):
+
+    """The zero bytes that take length up to the next multiple of ALIGNMENT"""
+
+    return b'\x00' * (-length % ALIGNMENT)
+
+
+def pack_preamble(magic, version, header):
+
+    """The magic, version, header length and JSON header of a file, padded out to where its arrays begin"""
+
+    header_bytes = json.dumps(header).encode('utf-8')
+    preamble = magic + struct.pack('<II', version, len(header_bytes)) + header_bytes
+    return preamble + padding(len(preamble))
+
+
+def read_preamble(file_path, magic, version, error=BinaryFormatError, kind='binary file'):
+
+    """Read and check the preamble of a file written with pack_preamble. Returns (header, array_section_offset); raises
+    error (naming the file a kind) if the magic, version or header are wrong or the file is cut short.
+    """
+
+    with open(file_path, 'rb') as f:
+        if f.read(len(magic)) != magic:
+            raise error('{} is not a {}'.format(file_path, kind))
+        try:
+            file_version, header_length = struct.unpack('<II', f.read(8))
+            header_bytes = f.read(header_length)
+            if len(header_bytes) != header_length:
+                raise error('{} is truncated in its header'.format(file_path))
+            header = json.loads(header_bytes.decode('utf-8'))
+        except (struct.error, UnicodeDecodeError, json.JSONDecodeError) as corrupt:
+            raise error('{} has a corrupt header: {}'.format(file_path, corrupt))
+
+    if file_version != version:
+        raise error('{} is version {}, but only version {} is supported'.format(file_path, file_version, version))
+    if not isinstance(header, dict):
+        raise error('{} has a corrupt header'.format(file_path))
+
+    preamble_length = len(magic) + 8 + header_length
+    return header, preamble_length + (-preamble_length % ALIGNMENT)
+
+
+def write_arrays(file_path, magic, version, header, arrays, layout):
+
+    """Write a file: header (a dict, to which each array's offset and shape are added) and then the arrays named in
+    layout, a sequence of (name, dtype) pairs, in that order.
+    """
+
+    offset = 0
+    for name, dtype in layout:      # array offsets are relative to the (aligned) start of the array section
+        header[name] = {'offset': offset, 'shape': arrays[name].shape}
+        offset += arrays[name].nbytes + (-arrays[name].nbytes % ALIGNMENT)
+
+    temporary_path = '{}.{}.tmp'.format(file_path, os.getpid())
+    with open(temporary_path, 'wb') as f:
+        f.write(pack_preamble(magic, version, header))
+        for name, dtype in layout:
+            data = np.ascontiguousarray(arrays[name], dtype=dtype).tobytes()
+            f.write(data + padding(len(data)))
+    os.replace(temporary_path, file_path)
+
+
+def map_arrays(file_path, header, base, layout, error=BinaryFormatError):
+
+    """Memory-map the arrays of layout from a file whose array section starts at base, as read_preamble found it.
+    Empty arrays, which can't be mapped, come back as ordinary empty arrays.
+    """
+
+    file_size = os.path.getsize(file_path)
+    arrays = {}
+    for name, dtype in layout:
+        try:
+            shape = tuple(int(n) for n in header[name]['shape'])
+            offset = base + int(header[name]['offset'])
+        except (KeyError, TypeError, ValueError) as corrupt:
+            raise error('{} has no valid entry for its {} array: {!r}'.format(file_path, name, corrupt))
+
+        length = int(np.prod(shape)) * np.dtype(dtype).itemsize
+        if min(shape, default=0) < 0 or offset < base or offset + length > file_size:
+            raise error('{} is truncated: its {} array does not fit in the file'.format(file_path, name))
+        if length:
+            arrays[name] = np.memmap(file_path, dtype=dtype, mode='r', offset=offset, shape=shape)
+        else:
+            arrays[name] = np.zeros(shape, dtype=dtype)
+    return arrays
+
+
+class ArrayFile(object):
+    """ArrayFile
+    Read-only, memory-mapped access to a file of one of the formats. A format subclasses it and sets MAGIC, VERSION,
+    LAYOUT (the (name, dtype) pairs of its arrays), ERROR (its exception class) and KIND (what to call it in errors);
+    the header is then in self.header and the arrays in self.arrays. Formats whose records have ids keep them as
+    id_offsets / id_blob arrays, and get id() and ids() from here.
+    """
+
+    MAGIC = None
+    VERSION = None
+    LAYOUT = ()
+    ERROR = BinaryFormatError
+    KIND = 'binary file'
+
+    def __init__(self, file_path):
+
+        self.file_path = file_path
+        self.header, base = read_preamble(file_path, self.MAGIC, self.VERSION, self.ERROR, self.KIND)
+        self.arrays = map_arrays(file_path, self.header, base, self.LAYOUT, self.ERROR)
+
+    def id(self, record):
+
+        start, end = self.arrays['id_offsets'][record:record + 2]
+        return bytes(self.arrays['id_blob'][start:end]).decode('utf-8')
+
+    def ids(self):
+
+        return [self.id(record) for record in range(len(self))]
+
+    def close(self):
+
+        self.arrays = None
+
+
+def id_arrays(ids):
+
+    """The id_offsets and id_blob arrays for a list of string ids"""
+
+    encoded_ids = [record_id.encode('utf-8') for record_id in ids]
+    return {'id_offsets': np.concatenate(([0], np.cumsum([len(i) for i in encoded_ids]))).astype('<i8'),
+            'id_blob': np.frombuffer(b''.join(encoded_ids), dtype=np.uint8)}
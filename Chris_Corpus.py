@@ -0,0 +1,245 @@
+"""Chris_Corpus
+A compact binary form of a FastA file, built once and memory-mapped on every later run instead of re-parsing the text.
+
+Layout of a .corpus file:
+
+    magic       8 bytes     b'TMMCORP\\x01'
+    version     uint32      little-endian, currently 1
+    header_len  uint32      little-endian, length in bytes of the JSON header that follows
+    header      JSON        alphabet, states, record count, the source file's size, mtime and SHA-256, and the offset
+                            of each array below
+    arrays      (each aligned to 64 bytes, see Chris_BinaryFormat)
+        residues        uint8, every record's residues end to end, as indices into alphabet
+        labels          uint8, parallel to residues: the '#' annotation as indices into states, 255 where there is none
+        offsets         int64, record i is residues[offsets[i]:offsets[i + 1]]
+        id_offsets      int64, record i's header is id_blob[id_offsets[i]:id_offsets[i + 1]]
+        id_blob         the UTF-8 headers, concatenated
+
+The alphabet is just the set of symbols that occur in the file, so a corpus does not depend on any model; a model
+maps it onto its own symbol indices with one small lookup table (see Corpus.encoded_for and training_records).
+"""
+
+__author__ = 'Wombat'
+
+from hashlib import sha256
+import os
+import numpy as np
+import Chris_BinaryFormat
+from FastA_V2 import AnnotatedFastA
+
+MAGIC = b'TMMCORP\x01'
+VERSION = 1
+SUFFIX = '.corpus'
+NO_LABEL = 255
+ARRAYS = (('residues', np.dtype('u1')), ('labels', np.dtype('u1')), ('offsets', np.dtype('<i8')),
+          ('id_offsets', np.dtype('<i8')), ('id_blob', np.dtype('u1')))
+
+
+class CorpusError(Chris_BinaryFormat.BinaryFormatError):
+
+    """Raised when a corpus file is malformed, truncated or of an unknown version"""
+
+
+def file_digest(file_path):
+
+    digest = sha256()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def build_corpus(fasta_path, corpus_path=None):
+
+    """Parse a FastA file (with FastA_V2.AnnotatedFastA) and write it out as a corpus. A record's '#' annotation, if
+    it has one of the same length as its sequence, becomes its labels; a mismatched annotation is reported and dropped.
+    Returns the corpus path.
+    """
+
+    corpus_path = corpus_path or fasta_path + SUFFIX
+    stat = os.stat(fasta_path)
+
+    headers = []
+    sequences = []
+    annotations = []        # (record number, labels) for the labeled records
+    for annotation, sequence, labels in AnnotatedFastA(fasta_path, strict=False):
+        if labels is not None:
+            annotations.append((len(headers), labels))
+        headers.append(annotation)
+        sequences.append(sequence)
+
+    # One pass of np.unique over all of the residues at once gives both the alphabet and the encoding
+    raw = np.frombuffer(''.join(sequences).encode('latin-1'), dtype=np.uint8)
+    alphabet, residues = np.unique(raw, return_inverse=True)
+    lengths = [len(sequence) for sequence in sequences]
+    offsets = np.concatenate(([0], np.cumsum(lengths))).astype('<i8')
+
+    raw_labels = np.frombuffer(''.join(labels for record, labels in annotations).encode('latin-1'), dtype=np.uint8)
+    states, label_codes = np.unique(raw_labels, return_inverse=True)
+    labels = np.full(len(residues), NO_LABEL, dtype=np.uint8)
+    if len(annotations):
+        label_positions = np.concatenate([np.arange(offsets[record], offsets[record + 1])
+                                          for record, record_labels in annotations])
+        labels[label_positions] = label_codes
+    if len(alphabet) > 255 or len(states) > 255:
+        raise CorpusError('A corpus holds at most 255 symbols and 255 states')
+
+    arrays = {'residues': residues.astype(np.uint8), 'labels': labels, 'offsets': offsets}
+    arrays.update(Chris_BinaryFormat.id_arrays(headers))
+
+    header = {'alphabet': bytes(alphabet).decode('latin-1'), 'states': bytes(states).decode('latin-1'),
+              'records': len(headers), 'source': {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns,
+                                                  'sha256': file_digest(fasta_path)}}
+    Chris_BinaryFormat.write_arrays(corpus_path, MAGIC, VERSION, header, arrays, ARRAYS)
+
+    return corpus_path
+
+
+def load_corpus(fasta_path, corpus_path=None):
+
+    """The Corpus for a FastA file, from its cached .corpus file when that is still current and built afresh otherwise.
+    The cache is current if the source file's size and modification time are what they were when it was built, or,
+    if only the time has changed (the file was copied or touched), if its SHA-256 is still the same. A cache file that
+    is missing, truncated or otherwise unreadable is simply rebuilt.
+    """
+
+    corpus_path = corpus_path or fasta_path + SUFFIX
+    try:
+        corpus = Corpus(corpus_path)
+    except (OSError, CorpusError):
+        corpus = None
+
+    if corpus is not None:
+        stat = os.stat(fasta_path)
+        source = corpus.source
+        if source['size'] == stat.st_size and (source['mtime_ns'] == stat.st_mtime_ns or
+                                               source['sha256'] == file_digest(fasta_path)):
+            return corpus
+        corpus.close()
+
+    print('Building corpus', corpus_path, 'from', fasta_path)
+    return Corpus(build_corpus(fasta_path, corpus_path))
+
+
+class Corpus(Chris_BinaryFormat.ArrayFile):
+    """Corpus
+    Read-only, memory-mapped access to a .corpus file (see build_corpus and load_corpus). Every per-record accessor
+    returns a view of the mapped file, without copying or parsing anything.
+    """
+
+    MAGIC = MAGIC
+    VERSION = VERSION
+    LAYOUT = ARRAYS
+    ERROR = CorpusError
+    KIND = 'corpus'
+
+    def __init__(self, file_path):
+
+        super().__init__(file_path)
+        try:
+            self.alphabet = self.header['alphabet']
+            self.states = self.header['states']
+            self.source = {key: self.header['source'][key] for key in ('size', 'mtime_ns', 'sha256')}
+        except (KeyError, TypeError) as error:
+            raise CorpusError('{} has an incomplete header: {!r}'.format(file_path, error))
+
+        offsets = self.arrays['offsets']
+        if not len(offsets) or offsets[0] != 0 or offsets[-1] != len(self.arrays['residues']) or \
+                len(self.arrays['labels']) != len(self.arrays['residues']):
+            raise CorpusError('{} has record offsets that do not match its residues'.format(file_path))
+
+    def __len__(self):
+
+        return len(self.arrays['offsets']) - 1
+
+    def residues(self, record):
+
+        """A record's residues, as indices into self.alphabet"""
+
+        start, end = self.arrays['offsets'][record:record + 2]
+        return self.arrays['residues'][start:end]
+
+    def labels(self, record):
+
+        """A record's labels, as indices into self.states, or None if it has none"""
+
+        start, end = self.arrays['offsets'][record:record + 2]
+        labels = self.arrays['labels'][start:end]
+        return None if not len(labels) or labels[0] == NO_LABEL else labels
+
+    def sequence(self, record):
+
+        return ''.join(self.alphabet[i] for i in self.residues(record).tolist())
+
+    def label_string(self, record):
+
+        labels = self.labels(record)
+        return None if labels is None else ''.join(self.states[i] for i in labels.tolist())
+
+    def __iter__(self):
+
+        """(header, sequence) tuples, as FastA_V2.FastA yields them for an unannotated file"""
+
+        for record in range(len(self)):
+            yield self.id(record), self.sequence(record)
+
+    def matrix(self):
+
+        """For a corpus whose records all have the same length (an alignment): a (records x columns) view of all of the
+        residues, with no copy
+        """
+
+        offsets = self.arrays['offsets']
+        lengths = np.diff(offsets)
+        if len(lengths) and (lengths != lengths[0]).any():
+            raise CorpusError('The records of {} are not all the same length'.format(self.file_path))
+        return self.arrays['residues'].reshape(len(self), -1 if len(self) else 0)
+
+    def symbol_lookup(self, model):
+
+        """An array mapping corpus symbol indices to model's symbol indices (its catch-all for unknown symbols)"""
+
+        return np.array([model.symbol_index.get(symbol, model.unknown_symbol) for symbol in self.alphabet] +
+                        [model.unknown_symbol], dtype=np.intp)
+
+    def encoded_for(self, model, record, start_symbol='_', lookup=None):
+
+        """A record as model's encoded input, with the start column symbol in front as the decoders expect. The result
+        can go straight into any CompiledHMM decoding method in place of the sequence string.
+        """
+
+        lookup = self.symbol_lookup(model) if lookup is None else lookup
+        return np.concatenate(([model.symbol_index[start_symbol]], lookup[self.residues(record)]))
+
+    def training_records(self, model, start_symbol='_', labeled_only=False):
+
+        """(sequence, labels) pairs for BaumWelch.train or Chris_CrossValidation, already encoded for model: labels
+        are arrays of model state indices, beginning with its start state, or None for an unlabeled record.
+        """
+
+        lookup = self.symbol_lookup(model)
+        state_lookup = np.array([model.state_index[state] for state in self.states], dtype=np.intp)
+
+        records = []
+        for record in range(len(self)):
+            labels = self.labels(record)
+            if labels is None and labeled_only:
+                continue
+            sequence = self.encoded_for(model, record, start_symbol, lookup)
+            if labels is not None:
+                labels = np.concatenate(([model.start], state_lookup[labels]))
+            records.append((sequence, labels))
+        return records
+
+
+def main(fasta_paths=('160_membrane_prots.txt', '645_non_membrane_prots.txt.fasta', 'Chris_Gyrb_aligned.fa.txt')):
+
+    for fasta_path in fasta_paths:
+        corpus = load_corpus(fasta_path)
+        labeled = sum(corpus.labels(record) is not None for record in range(len(corpus)))
+        print(fasta_path, len(corpus), 'records,', len(corpus.arrays['residues']), 'residues,', labeled, 'labeled,',
+              'alphabet', corpus.alphabet, 'states', corpus.states)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,170 @@
+__author__ = 'Wombat'
+
+from concurrent.futures import ProcessPoolExecutor
+from os import cpu_count
+from random import Random
+from time import perf_counter
+import numpy as np
+import TMM_HMM_dicts
+import Chris_Corpus
+from Chris_BaumWelch import BaumWelch
+from Chris_FastHMM import CompiledHMM
+from Chris_TopologyStore import path_segments
+from FastA_V2 import AnnotatedFastA
+
+
+def read_labeled_records(fasta_path):
+
+    """The '#'-annotated records of a FastA file as (annotation, sequence, labels) triples, with the usual start column
+    ('_' on the sequence, 'S' on the labels). Records without labels, or whose labels don't match their sequence in
+    length, are left out (and the mismatched ones reported).
+    """
+
+    return [(annotation, "_" + acid, "S" + labels)
+            for annotation, acid, labels in AnnotatedFastA(fasta_path, strict=False) if labels is not None]
+
+
+def segment_overlap(observed, predicted):
+
+    """The segment overlap (SOV) sums for one record, compared over every state but the start state. Returns
+    (score, normalizer); the SOV of a set of records is 100 * sum(score) / sum(normalizer).
+
+    Following Rost, Sander and Schneider (1994): for every observed segment s1 and every predicted segment s2 of the
+    same state that overlaps it, s1 earns len(s1) * (minov + delta) / maxov, where minov is the length of the overlap,
+    maxov the length of the union, and delta = min(maxov - minov, minov, len(s1) / 2, len(s2) / 2) a small allowance for
+    segment ends. The normalizer counts len(s1) once per overlapping pair, or once for an s1 that nothing overlaps.
+    """
+
+    score = 0.0
+    normalizer = 0
+    predicted_segments = path_segments(predicted[1:])
+    for state, start, end in path_segments(observed[1:]):
+        length = end - start
+        overlapping = [(p_start, p_end) for p_state, p_start, p_end in predicted_segments
+                       if p_state == state and p_start < end and start < p_end]
+        if not overlapping:
+            normalizer += length
+            continue
+        for p_start, p_end in overlapping:
+            minov = min(end, p_end) - max(start, p_start)
+            maxov = max(end, p_end) - min(start, p_start)
+            delta = min(maxov - minov, minov, length // 2, (p_end - p_start) // 2)
+            score += length * (minov + delta) / maxov
+            normalizer += length
+    return score, normalizer
+
+
+def run_fold(starting_model, training, test, pseudocount=0.01):
+
+    """Train on one split and evaluate on the other, in a worker process. The model is estimated straight from the
+    training labels (BaumWelch.estimate_from_labels), within the topology of starting_model. Returns a dict of sums that
+    evaluate() adds up over the folds.
+    """
+
+    model = BaumWelch(starting_model, processes=1, pseudocount=pseudocount).estimate_from_labels(training)
+
+    number_of_states = len(model.states)
+    correct = np.zeros(number_of_states)
+    observed = np.zeros(number_of_states)
+    predicted = np.zeros(number_of_states)
+    sov_score = sov_normalizer = 0
+
+    decoded = model.viterbi_batch([sequence for sequence, labels in test])
+    for (sequence, labels), (score, path) in zip(test, decoded):
+        labels = ''.join(model.decode_states(model.encode_path(labels)))     # labels may come encoded, from a corpus
+        actual = model.encode_path(labels[1:])
+        guess = model.encode_path(path[1:])
+        correct += np.bincount(actual[actual == guess], minlength=number_of_states)
+        observed += np.bincount(actual, minlength=number_of_states)
+        predicted += np.bincount(guess, minlength=number_of_states)
+
+        record_score, record_normalizer = segment_overlap(labels, ''.join(path))
+        sov_score += record_score
+        sov_normalizer += record_normalizer
+
+    return {'states': model.states, 'correct': correct, 'observed': observed, 'predicted': predicted,
+            'sov_score': sov_score, 'sov_normalizer': sov_normalizer, 'records': len(test)}
+
+
+def make_folds(number_of_records, k=5, seed=0):
+
+    """Shuffle the record indices (reproducibly, for a given seed) and deal them out into k folds"""
+
+    indices = list(range(number_of_records))
+    Random(seed).shuffle(indices)
+    return [sorted(indices[fold::k]) for fold in range(k)]
+
+
+def evaluate(fold_results):
+
+    """Combine the per-fold sums into a report: overall per-residue Q accuracy, per-state Q (recall) and precision,
+    SOV, and the same Q accuracy and SOV for each fold on its own
+    """
+
+    states = fold_results[0]['states']
+    correct = sum(result['correct'] for result in fold_results)
+    observed = sum(result['observed'] for result in fold_results)
+    predicted = sum(result['predicted'] for result in fold_results)
+
+    def sov(results):
+        normalizer = sum(result['sov_normalizer'] for result in results)
+        return 100 * sum(result['sov_score'] for result in results) / normalizer if normalizer else 0.0
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return {
+            'records': sum(result['records'] for result in fold_results),
+            'q_accuracy': correct.sum() / observed.sum(),
+            'q_state': {state: float(correct[i] / observed[i]) for i, state in enumerate(states) if observed[i]},
+            'precision_state': {state: float(correct[i] / predicted[i]) for i, state in enumerate(states)
+                                if predicted[i]},
+            'sov': sov(fold_results),
+            'folds': [{'q_accuracy': result['correct'].sum() / result['observed'].sum(), 'sov': sov([result])}
+                      for result in fold_results],
+        }
+
+
+def cross_validate(records, k=5, seed=0, starting_model=None, pseudocount=0.01, workers=None):
+
+    """k-fold cross-validation of supervised training on records, (sequence, labels) pairs (labels beginning with the
+    start state), as strings or already encoded for starting_model (see Chris_Corpus.Corpus.training_records). The
+    folds are trained and decoded in parallel, one per worker process. starting_model fixes which transitions and
+    emissions may exist at all (by default, the TMM_HMM_dicts topology). Returns evaluate()'s report.
+    """
+
+    if starting_model is None:
+        starting_model = CompiledHMM.from_probabilities(TMM_HMM_dicts.states, TMM_HMM_dicts.emissions)
+    k = min(k, len(records))
+    folds = make_folds(len(records), k, seed)
+
+    splits = []
+    for fold in folds:
+        held_out = set(fold)
+        splits.append(([record for i, record in enumerate(records) if i not in held_out],
+                       [records[i] for i in fold]))
+
+    with ProcessPoolExecutor(min(workers or cpu_count() or 1, k)) as pool:
+        fold_results = list(pool.map(run_fold, [starting_model] * k, *zip(*splits), [pseudocount] * k))
+
+    return evaluate(fold_results)
+
+
+def main(fasta_path='160_membrane_prots.txt', k=10):
+
+    # Repeat runs read the labeled records straight out of the memory-mapped corpus, already encoded
+    starting_model = CompiledHMM.from_probabilities(TMM_HMM_dicts.states, TMM_HMM_dicts.emissions)
+    records = Chris_Corpus.load_corpus(fasta_path).training_records(starting_model, labeled_only=True)
+    started = perf_counter()
+    report = cross_validate(records, k, starting_model=starting_model)
+    elapsed = perf_counter() - started
+
+    print('{}-fold cross-validation on {} records of {} in {:.2f}s'.format(k, report['records'], fasta_path, elapsed))
+    print('Q accuracy: {:.4f}   SOV: {:.2f}'.format(report['q_accuracy'], report['sov']))
+    print('Per-state Q:', {state: round(q, 4) for state, q in report['q_state'].items()})
+    print('Per-state precision:', {state: round(p, 4) for state, p in report['precision_state'].items()})
+    for fold, fold_report in enumerate(report['folds']):
+        print('Fold', fold + 1,
+              'Q accuracy: {:.4f}   SOV: {:.2f}'.format(fold_report['q_accuracy'], fold_report['sov']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,194 @@
+__author__ = 'Wombat'
+
+from collections import OrderedDict
+from hashlib import sha256
+from threading import Lock
+import os
+import numpy as np
+
+
+def _immutable(result):
+
+    """result with every list in it turned into a tuple and every array made read-only, so that the one cached copy
+    can safely be handed out to every caller
+    """
+
+    if isinstance(result, (list, tuple)):
+        return tuple(_immutable(item) for item in result)
+    if isinstance(result, np.ndarray):
+        result.setflags(write=False)
+    return result
+
+
+def _save_entry(f, result):
+
+    """Write a (score, value) result to the open file f as an .npz: value is a Viterbi path of state names or an array
+    such as the forward table
+    """
+
+    score, value = result
+    np.savez(f, score=np.float64(score), value=np.asarray(value))
+
+
+def _load_entry(file_path):
+
+    """The immutable (score, value) result saved in file_path by _save_entry, or None if it is missing or isn't one"""
+
+    try:
+        with np.load(file_path, allow_pickle=False) as entry:
+            if sorted(entry.files) != ['score', 'value']:
+                return None
+            score, value = entry['score'], entry['value']
+    except Exception:       # missing, truncated, not an .npz at all ...: a miss, and put() will replace it
+        return None
+
+    if score.shape != () or score.dtype.kind != 'f' or value.ndim not in (1, 2):
+        return None
+    if value.dtype.kind == 'U' and value.ndim == 1:
+        return float(score), tuple(str(state) for state in value)
+    if value.dtype.kind == 'f':
+        return _immutable((float(score), value))
+    return None
+
+
+class DecodeCache(object):
+    """DecodeCache
+    Memoizes decoding results, since proteomes are full of exact duplicate sequences (isoforms, redundant strains) and
+    there is no point in running Viterbi on the same sequence twice.
+
+    Results are keyed by a SHA-256 of the model's fingerprint, the decode mode and the encoded sequence, so a cached
+    result can never be served for a different model, and sequences that only differ in ways the model can't see (case,
+    or two symbols that are both outside the alphabet) share one entry. There are two tiers:
+
+        memory  an LRU dict of at most max_entries results, private to this process
+        disk    optionally, a directory of results that survives between runs (and can be shared by several
+                processes, as every file is written under a temporary name and then atomically renamed into place)
+
+Disk entries are plain .npz files (a score and a value array; no pickles, so a cache directory is safe to share),
+and anything that doesn't load as one, for whatever reason, is treated as a miss and overwritten by put().
+
+    Every caller of the same sequence gets the very same result object, so results are stored immutable: a Viterbi
+    result comes back as a (log_prob, path) tuple whose path is a tuple of state names, and arrays are read-only.
+
+    The hits, disk_hits and misses counters record how much recomputation the cache has saved.
+    """
+
+    def __init__(self, model, max_entries=100000, directory=None):
+
+        self.model = model
+        self.model_id = model.fingerprint()
+        self.max_entries = max_entries
+        self.directory = directory
+        self.entries = OrderedDict()        # key -> result, least recently used first
+        self.lock = Lock()                  # so that one cache can be shared by the threads of a decoding service
+
+        self.hits = 0           # served from memory
+        self.disk_hits = 0      # served from the disk tier (and promoted into memory)
+        self.misses = 0         # had to be decoded
+
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def key(self, sequence, mode='viterbi'):
+
+        digest = sha256(self.model_id.encode())
+        digest.update(mode.encode())
+        digest.update(self.model.encode(sequence).astype(np.uint16).tobytes())
+        return digest.hexdigest()
+
+    def get(self, key):
+
+        """The cached result for key, or None"""
+
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key]
+
+        if self.directory:
+            result = _load_entry(self._path(key))
+            if result is not None:
+                with self.lock:
+                    self.disk_hits += 1
+                self._remember(key, result)
+                return result
+
+        with self.lock:
+            self.misses += 1
+        return None
+
+    def put(self, key, result):
+
+        """Cache result under key, and return it in the immutable form every later get() will give"""
+
+        result = _immutable(result)
+        self._remember(key, result)
+
+        if self.directory:
+            path = self._path(key)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            temporary_path = '{}.{}.tmp'.format(path, os.getpid())
+            with open(temporary_path, 'wb') as f:
+                _save_entry(f, result)
+            os.replace(temporary_path, path)
+        return result
+
+    def decode(self, sequence, mode='viterbi'):
+
+        """The result of model.<mode>(sequence), e.g. mode='viterbi' or 'forward', computed only if not cached"""
+
+        key = self.key(sequence, mode)
+        result = self.get(key)
+        if result is None:
+            result = self.put(key, getattr(self.model, mode)(sequence))
+        return result
+
+    def decode_many(self, sequences, mode='viterbi'):
+
+        """Like decode for each sequence in turn, but duplicates within sequences are only looked up once, and in
+        viterbi mode all of the misses are decoded together with the batched engine.
+        """
+
+        keys = [self.key(sequence, mode) for sequence in sequences]
+        results = {}
+        missing = {}        # key -> sequence, for the distinct sequences we have to decode
+
+        for key, sequence in zip(keys, sequences):
+            if key in results or key in missing:
+                with self.lock:
+                    self.hits += 1
+                continue
+            result = self.get(key)
+            if result is None:
+                missing[key] = sequence
+            else:
+                results[key] = result
+
+        if missing:
+            if mode == 'viterbi':
+                decoded = self.model.viterbi_batch(list(missing.values()))
+            else:
+                decoded = [getattr(self.model, mode)(sequence) for sequence in missing.values()]
+            for key, result in zip(missing, decoded):
+                results[key] = self.put(key, result)
+
+        return [results[key] for key in keys]
+
+    def stats(self):
+
+        lookups = self.hits + self.disk_hits + self.misses
+        return {'hits': self.hits, 'disk_hits': self.disk_hits, 'misses': self.misses, 'entries': len(self.entries),
+                'hit_rate': (self.hits + self.disk_hits) / lookups if lookups else 0.0}
+
+    def _remember(self, key, result):
+
+        with self.lock:
+            self.entries[key] = result
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)      # evict the least recently used
+
+    def _path(self, key):
+
+        return os.path.join(self.directory, key[:2], key + '.npz')
@@ -0,0 +1,928 @@
+__author__ = 'Wombat'
+
+from collections import deque
+from copy import copy
+from functools import lru_cache
+from hashlib import sha256
+from pickle import load
+from types import MappingProxyType
+import math
+import numpy as np
+import TMM_HMM_dicts
+import Chris_ModelFile
+import FastA_V2
+
+
+SPARSE_MIN_STATES = 100     # models this big, with no more than SPARSE_DENSITY of the possible transitions,
+SPARSE_BATCH_MIN_STATES = 64    # (or this big, for batched decoding) decode sparsely by default
+SPARSE_DENSITY = 0.25
+
+
+def log_sum_exp(values, axis=0):
+
+    """Numerically stable log(sum(exp(values))) along axis. Slices that are entirely -inf give -inf (rather than nan),
+    so impossible states stay impossible.
+    """
+
+    peak = values.max(axis=axis, keepdims=True)
+    peak = np.where(np.isfinite(peak), peak, 0)
+    with np.errstate(divide='ignore'):         # log(0) = -inf is exactly what we want for an all -inf slice
+        summed = np.log(np.exp(values - peak).sum(axis=axis, keepdims=True))
+    return np.squeeze(summed + peak, axis=axis)
+
+
+@lru_cache(maxsize=None)
+def load_compiled_model(file_path='acid_dict'):
+
+    """The TMM model as a CompiledHMM: transitions from the pickled file_path, emissions from TMM_HMM_dicts. The file is
+    read and log-transformed only the first time this is called in a process; every later call gets the same object.
+    A file_path ending in .tmm is instead memory-mapped as a pre-compiled binary model artifact.
+    """
+
+    if file_path.endswith(Chris_ModelFile.SUFFIX):      # a binary artifact written by Chris_ModelFile, no pickling
+        return Chris_ModelFile.load_model_artifact(file_path)
+
+    print("Loading model file", file_path)
+    with open(file_path, 'rb') as f:
+        transitions = load(f)
+    return CompiledHMM.from_probabilities(transitions, TMM_HMM_dicts.emissions)
+
+
+class CompiledHMM(object):
+    """CompiledHMM
+    A vectorized decoding engine for the HMM class in Chris_MiniHMM.py.
+
+    The HMM class keeps its transitions and emissions as dict-of-dicts keyed by state and symbol, and the Viterbi
+    recursion walks them with a try / except KeyError for every state pair at every position. Here we compile those
+    same log-space tables once into dense matrices, with states and symbols replaced by integer indices:
+
+        log_transitions[k, l]   log P(state l | state k), -inf where the transition does not exist
+        log_emissions[l, c]     log P(symbol c | state l), -inf where state l cannot emit symbol c
+
+    The last column of log_emissions is reserved for symbols that are not in the alphabet at all (X, U, B, Z and the
+    like, which turn up all over full proteomes). It holds each state's background score for such a residue, the log of
+    the total probability of everything the state can emit (so 0, up to rounding, for a normalized row): the residue
+    is taken to be one the state could have emitted, without saying which. An unknown residue therefore never makes a
+    sequence impossible, it just leaves the choice of state at that position to its neighbours.
+
+    The recursion is then carried out as array operations over states, and instead of carrying a full best-path list
+    along for every state (which costs a copy per state per position) we record a single backpointer per cell and
+    trace back once at the end.
+
+    A CompiledHMM is immutable once built (its arrays are read-only and its attributes cannot be reassigned), and no
+    decoding method keeps any per-sequence state on the object, so a single model can be built once per process and
+    then shared by any number of threads calling decode() at the same time.
+    """
+
+    def __init__(self, log_states, log_emissions, start_state='S'):
+
+        states = sorted(log_states)        # a fixed state order, so that the state index is reproducible
+        state_index = {state: i for i, state in enumerate(states)}
+        alphabet = sorted({symbol for emits in log_emissions.values() for symbol in emits})
+        symbol_index = {symbol: i for i, symbol in enumerate(alphabet)}
+
+        log_transitions = np.full((len(states), len(states)), -np.inf)
+        for old_state_k, transitions in log_states.items():
+            for new_state_l, log_prob in transitions.items():
+                log_transitions[state_index[old_state_k], state_index[new_state_l]] = log_prob
+
+        emission_table = np.full((len(states), len(alphabet) + 1), -np.inf)
+        for state, emits in log_emissions.items():
+            for symbol, log_prob in emits.items():
+                emission_table[state_index[state], symbol_index[symbol]] = log_prob
+
+        self._build(states, alphabet, start_state, log_transitions, emission_table)
+
+    @classmethod
+    def from_arrays(cls, states, alphabet, log_transitions, log_emissions, start_state='S'):
+
+        """Build a model directly from already index-encoded log tables (e.g. memory-mapped from a model artifact).
+        log_emissions must have one more column than alphabet has symbols, for the unknown-symbol catch-all.
+        """
+
+        model = cls.__new__(cls)
+        model._build(list(states), list(alphabet), start_state, log_transitions, log_emissions)
+        return model
+
+    def _build(self, states, alphabet, start_state, log_transitions, log_emissions):
+
+        self.states = states
+        self.state_index = {state: i for i, state in enumerate(self.states)}
+
+        self.alphabet = alphabet
+        self.symbol_index = {symbol: i for i, symbol in enumerate(self.alphabet)}
+        self.unknown_symbol = len(self.alphabet)    # index of the catch-all column for out-of-alphabet symbols
+
+        self.start = self.state_index[start_state]
+
+        self.log_transitions = log_transitions
+        self.transitions = np.exp(self.log_transitions)     # plain probabilities for the sum-product recursions
+        self.log_emissions = self._with_background(log_emissions)
+        self.dtype = self.log_transitions.dtype        # float64 normally, float32 for a compact model (as_dtype)
+        self.state_range = np.arange(len(self.states))
+        self._compile_predecessors()
+
+        # A 256-entry lookup table lets us encode a whole sequence with one numpy fancy-indexing operation
+        self.lookup = np.full(256, self.unknown_symbol, dtype=np.intp)
+        for symbol, i in self.symbol_index.items():
+            self.lookup[ord(symbol)] = i
+
+        # The same trick for state paths, when every state name is a single character (-1 marks a non-state)
+        self.state_lookup = np.full(256, -1, dtype=np.intp)
+        if all(len(state) == 1 for state in self.states):
+            for state, i in self.state_index.items():
+                self.state_lookup[ord(state)] = i
+
+        self._freeze()
+
+    @staticmethod
+    def _with_background(log_emissions):
+
+        """log_emissions with its catch-all column filled in with every state's background score (see the class
+        docstring). A table that already has it (e.g. a memory-mapped model artifact) is returned as it is, uncopied.
+        """
+
+        background = log_sum_exp(log_emissions[:, :-1], axis=1)
+        if np.array_equal(log_emissions[:, -1], background):
+            return log_emissions
+        log_emissions = np.array(log_emissions)
+        log_emissions[:, -1] = background
+        return log_emissions
+
+    def fingerprint(self):
+
+        """A SHA-256 hex digest of everything that determines the model's output (states, alphabet, start state and the
+        log tables), so that two models with the same fingerprint decode identically.
+        """
+
+        digest = sha256()
+        digest.update(repr((tuple(self.states), tuple(self.alphabet), self.start)).encode())
+        digest.update(np.ascontiguousarray(self.log_transitions, dtype='<f8').tobytes())
+        digest.update(np.ascontiguousarray(self.log_emissions, dtype='<f8').tobytes())
+        return digest.hexdigest()
+
+    def _compile_predecessors(self):
+
+        """Precompile the sparse structure of the transition matrix. For each state, predecessors lists the states that
+        can legally move into it, and the same information is kept as one flat edge list sorted by destination state
+        (edge_sources, edge_log_transitions, with edge_starts marking where each destination's run of edges begins),
+        which is what the sparse Viterbi step works from.
+        """
+
+        sources, destinations = np.nonzero(self.log_transitions.T > -np.inf)[::-1]     # sorted by destination
+        self.predecessors = tuple(tuple(int(k) for k in sources[destinations == l]) for l in self.state_range)
+        self.edge_sources = sources
+        self.edge_destinations = destinations
+        self.edge_log_transitions = self.log_transitions[sources, destinations]
+        self.reachable_states = np.unique(destinations)      # states with at least one predecessor
+        self.edge_starts = np.searchsorted(destinations, self.reachable_states)
+
+        # Each sparse step costs a handful of numpy calls however few edges there are, so it only beats one dense
+        # (states x states) operation once the model is big: timed on random models with 2 to 64 edges per state, dense
+        # is 2-3 times faster up to 32 states, the two are level at 64 to 96, and sparse wins from 128 states up
+        # unless about a quarter or more of the state pairs are transitions. A batched step amortizes those calls over
+        # the whole bucket, so there the two are level at about 48 states and sparse wins clearly from 96.
+        few_edges = len(sources) <= SPARSE_DENSITY * len(self.states) ** 2
+        self.sparse = len(self.states) >= SPARSE_MIN_STATES and few_edges
+        self.sparse_batch = len(self.states) >= SPARSE_BATCH_MIN_STATES and few_edges
+
+    def _freeze(self):
+
+        self.states = tuple(self.states)
+        self.alphabet = tuple(self.alphabet)
+        self.state_index = MappingProxyType(self.state_index)
+        self.symbol_index = MappingProxyType(self.symbol_index)
+        for array in (self.log_transitions, self.transitions, self.log_emissions, self.lookup, self.state_lookup,
+                      self.state_range, self.edge_sources, self.edge_destinations, self.edge_log_transitions,
+                      self.reachable_states, self.edge_starts):
+            array.setflags(write=False)
+        self._frozen = True
+
+    def __getstate__(self):
+
+        state = dict(self.__dict__)     # mappingproxy objects can't be pickled, so ship plain dicts to worker processes
+        state['state_index'] = dict(self.state_index)
+        state['symbol_index'] = dict(self.symbol_index)
+        return state
+
+    def __setstate__(self, state):
+
+        self.__dict__.update(state)
+        object.__setattr__(self, '_frozen', False)
+        for name in ('log_transitions', 'transitions', 'log_emissions', 'lookup', 'state_lookup', 'state_range',
+                     'edge_sources', 'edge_destinations', 'edge_log_transitions', 'reachable_states', 'edge_starts'):
+            self.__dict__[name] = np.array(state[name])     # our own writeable copies, until frozen
+        self._freeze()
+
+    def __setattr__(self, name, value):
+
+        if getattr(self, '_frozen', False):
+            raise AttributeError('CompiledHMM is immutable; use with_tables() to make a modified copy')
+        object.__setattr__(self, name, value)
+
+    @classmethod
+    def from_hmm(cls, hmm, start_state='S'):
+
+        """Compile the log-space tables of an existing Chris_MiniHMM.HMM object."""
+
+        return cls(hmm.log_states, hmm.log_emissions, start_state)
+
+    @classmethod
+    def from_probabilities(cls, states, emissions, start_state='S'):
+
+        """Compile plain probability dict-of-dicts (the acid_dict / TMM_HMM_dicts layout), log-transforming them here"""
+
+        log_states = {outer_k: {inner_k: math.log(inner_v) for (inner_k, inner_v) in outer_v.items()}
+                      for (outer_k, outer_v) in states.items()}
+        log_emissions = {outer_k: {inner_k: math.log(inner_v) for (inner_k, inner_v) in outer_v.items()}
+                         for (outer_k, outer_v) in emissions.items()}
+        return cls(log_states, log_emissions, start_state)
+
+    def encode(self, sequence):
+
+        """Turn a sequence string into an array of symbol indices (unknown symbols map to the background column). An
+        array of integers is taken to be already encoded, and is passed straight through without a copy.
+        """
+
+        if isinstance(sequence, np.ndarray):
+            return sequence
+        return self.lookup[np.frombuffer(sequence.upper().encode('latin-1'), dtype=np.uint8)]
+
+    def encode_path(self, path):
+
+        """Turn a state path (a string or a list of state names) into an array of state indices. Raises KeyError for
+        anything that is not a state of the model. An array is taken to be already encoded and passed straight through.
+        """
+
+        if isinstance(path, np.ndarray):        # already encoded
+            return path
+        if isinstance(path, str) and self.state_lookup.max() >= 0:
+            encoded = self.state_lookup[np.frombuffer(path.encode('latin-1'), dtype=np.uint8)]
+            if (encoded < 0).any():
+                raise KeyError(path[int(np.argmax(encoded < 0))])
+            return encoded
+        return np.array([self.state_index[state] for state in path], dtype=np.intp)
+
+    def decode_states(self, state_indices):
+
+        """Turn an array of state indices back into a list of state names, as HMM.viterbi reports them"""
+
+        return [self.states[i] for i in state_indices]
+
+    def segments(self, state_indices):
+
+        """Run-length encode a path of state indices as a list of (state, start, end) segments, where start and end
+        are positions in the usual Python half-open sense (the segment covers start .. end - 1).
+        """
+
+        state_indices = np.asarray(state_indices)
+        if not len(state_indices):
+            return []
+        boundaries = np.flatnonzero(state_indices[1:] != state_indices[:-1]) + 1
+        starts = np.concatenate(([0], boundaries))
+        ends = np.concatenate((boundaries, [len(state_indices)]))
+        return [(self.states[state_indices[start]], int(start), int(end)) for start, end in zip(starts, ends)]
+
+    def _report(self, state_indices, as_segments):
+
+        return self.segments(state_indices) if as_segments else self.decode_states(state_indices)
+
+    def decode(self, sequence):
+
+        """Decode one sequence, returning its (log_prob, path) Viterbi tuple. Safe to call from many threads at once."""
+
+        return self.viterbi(sequence)
+
+    def viterbi(self, sequence, sparse=None, as_segments=False):
+
+        """Viterbi decoding of sequence, with the same conventions as HMM.viterbi: the first position of the sequence
+        is the start column (only the start state is allowed there, and it emits nothing), and the return value is a
+        (log_prob, path) tuple where path is a list of state names that begins with the start state.
+
+        With sparse=True each state only considers its legal predecessors, so the cost per position scales with the
+        number of possible transitions rather than states squared; sparse=False always uses the dense matrix, and the
+        default picks whichever is faster for the model (see _compile_predecessors). Both give the same result.
+        viterbi_checkpointed, viterbi_batch and StreamingViterbi take the same option; viterbi_nbest is always dense.
+
+        With as_segments the path comes back run-length encoded, as a list of (state, start, end) segments (see
+        segments()), without ever building the per-residue list.
+        """
+
+        encoded = self.encode(sequence)
+        length = len(encoded)
+        number_of_states = len(self.states)
+
+        column = np.full(number_of_states, -np.inf, dtype=self.dtype)     # the current column of the Viterbi table
+        column[self.start] = 0                          # everything must start in the start state, log(1) = 0
+
+        if length < 2:
+            return 0.0, self._report([self.start], as_segments)
+
+        emission_columns = self.log_emissions[:, encoded].T     # row t holds every state's emission score at t
+        backpointers = np.empty((length, number_of_states), dtype=np.intp)
+
+        step = self._step_function(sparse)
+        for position in range(1, length):
+            column, backpointers[position] = step(column, emission_columns[position])
+
+        # Termination, and a single traceback through the backpointers
+        path = np.empty(length, dtype=np.intp)
+        path[-1] = column.argmax()
+        for position in range(length - 1, 0, -1):
+            path[position - 1] = backpointers[position, path[position]]
+
+        return float(column[path[-1]]), self._report(path, as_segments)
+
+    def _step_function(self, sparse):
+
+        if sparse is None:
+            sparse = self.sparse
+        return self._sparse_viterbi_step if sparse else self._viterbi_step
+
+    def _viterbi_step(self, column, emission_column):
+
+        """One column of the Viterbi recursion. Returns (new_column, best_old_states)."""
+
+        # candidates[k, l] is the score of reaching state l from state k; the best k for each l is the argmax
+        candidates = column[:, np.newaxis] + self.log_transitions
+        best_old_states = candidates.argmax(axis=0)
+        return candidates[best_old_states, self.state_range] + emission_column, best_old_states
+
+    def _sparse_viterbi_step(self, column, emission_column):
+
+        """The same column of the recursion as _viterbi_step, computed over the legal transitions only. The edges are
+        grouped by destination state, so the maximum over each state's predecessors is a single reduceat, and the best
+        predecessor is the first edge in each group that attains it (the same tie-break as argmax in the dense step).
+        """
+
+        candidates = column[self.edge_sources] + self.edge_log_transitions
+        best = np.full(len(self.states), -np.inf, dtype=self.dtype)
+        best[self.reachable_states] = np.maximum.reduceat(candidates, self.edge_starts)
+
+        winners = np.flatnonzero(candidates == best[self.edge_destinations])
+        first_winners = winners[np.unique(self.edge_destinations[winners], return_index=True)[1]]
+        best_old_states = np.zeros(len(self.states), dtype=np.intp)     # unreachable states point at state 0, as dense
+        best_old_states[self.edge_destinations[first_winners]] = self.edge_sources[first_winners]
+
+        return best + emission_column, best_old_states
+
+    def viterbi_checkpointed(self, sequence, interval=None, sparse=None, as_segments=False):
+
+        """Viterbi decoding in O(sqrt(n)) memory, for sequences too long to keep the whole table. Returns exactly the
+        same (log_prob, path) as viterbi().
+
+        The forward pass keeps no backpointers at all, only a copy of the Viterbi column at every interval-th position
+        (by default interval = sqrt(n), giving sqrt(n) checkpoints). The traceback then works backwards one segment at
+        a time: from each checkpoint it recomputes the columns up to the next one, this time keeping that segment's
+        backpointers, and traces back through them. Every column is computed twice in total, in exchange for holding
+        only sqrt(n) columns plus one segment of backpointers at any moment.
+        """
+
+        encoded = self.encode(sequence)
+        length = len(encoded)
+
+        if length < 2:
+            return 0.0, self._report([self.start], as_segments)
+
+        interval = interval or max(1, math.isqrt(length))
+        step = self._step_function(sparse)
+
+        column = np.full(len(self.states), -np.inf, dtype=self.dtype)
+        column[self.start] = 0
+        checkpoints = {0: column}
+
+        for position in range(1, length):
+            column = step(column, self.log_emissions[:, encoded[position]])[0]
+            if position % interval == 0:
+                checkpoints[position] = column
+
+        path = np.empty(length, dtype=np.intp)
+        path[-1] = column.argmax()
+        score = float(column[path[-1]])
+
+        # Work backwards through the segments [checkpoint, segment_end], segment_end being the next checkpoint (whose
+        # state is already known) or the last position of the sequence
+        for checkpoint in sorted(checkpoints, reverse=True):
+            segment_end = min(checkpoint + interval, length - 1)
+            column = checkpoints[checkpoint]
+            backpointers = np.empty((segment_end - checkpoint + 1, len(self.states)), dtype=np.intp)
+            for position in range(checkpoint + 1, segment_end + 1):
+                column, backpointers[position - checkpoint] = step(column, self.log_emissions[:, encoded[position]])
+            for position in range(segment_end, checkpoint, -1):
+                path[position - 1] = backpointers[position - checkpoint, path[position]]
+
+        return score, self._report(path, as_segments)
+
+    def viterbi_nbest(self, sequence, k=5):
+
+        """List Viterbi: the k highest-scoring state paths through sequence, as a list of (log_prob, path) tuples, best
+        first. The first entry is the ordinary Viterbi result. Fewer than k are returned if fewer paths are possible.
+
+        Rather than a single best score, each state keeps a ranked list of its k best partial hypotheses at every
+        position. The k best hypotheses for a state are necessarily extensions of the k best hypotheses of its
+        predecessors, so at each position we only have to rank (states x k) candidates per state; the backpointers
+        record both the predecessor state and which of its k hypotheses was extended. This always works over the dense
+        transition matrix.
+        """
+
+        encoded = self.encode(sequence)
+        length = len(encoded)
+        number_of_states = len(self.states)
+
+        if length < 2:
+            return [(0.0, [self.states[self.start]])]
+
+        scores = np.full((number_of_states, k), -np.inf, dtype=self.dtype)    # scores[state, rank]: rank-th best so far
+        scores[self.start, 0] = 0
+        emission_columns = self.log_emissions[:, encoded].T
+        backpointers = np.empty((length, k, number_of_states), dtype=np.intp)   # flat (old state, old rank) index
+
+        for position in range(1, length):
+            # candidates[(k', r), l] = score of extending hypothesis r of state k' into state l
+            candidates = scores[:, :, np.newaxis] + self.log_transitions[:, np.newaxis, :]
+            candidates = candidates.reshape(-1, number_of_states)
+            ranking = np.argsort(-candidates, axis=0, kind='stable')[:k]    # each state's k best, ties to lowest index
+            backpointers[position] = ranking
+            scores = (np.take_along_axis(candidates, ranking, axis=0) + emission_columns[position][np.newaxis, :]).T
+
+        # Termination: the k best (state, rank) hypotheses over all states, each traced back separately
+        final_ranking = np.argsort(-scores.T.ravel(), kind='stable')[:k]
+        results = []
+
+        for flat in final_ranking:
+            rank, state = divmod(int(flat), number_of_states)
+            score = scores[state, rank]
+            if score == -np.inf:
+                break
+
+            path = np.empty(length, dtype=np.intp)
+            path[-1] = state
+            for position in range(length - 1, 0, -1):
+                state, rank = divmod(int(backpointers[position, rank, state]), k)
+                path[position - 1] = state
+            results.append((float(score), self.decode_states(path)))
+
+        return results
+
+    def score_paths(self, sequence, paths, null_state='I'):
+
+        """Score many candidate state paths for one sequence at once. Returns (log_probs, log_odds), two arrays with one
+        entry per path: the joint log probability of sequence and path (what HMM.evaluate computes for one path, but
+        with -inf rather than a KeyError for impossible paths), and its log-odds against the null model, which is the
+        all-null_state "fake path" the Chris_MiniHMM.py driver uses (start state, then null_state everywhere after).
+        As in the decoders, the first position of the sequence is the start column and emits nothing, so the score of
+        the Viterbi path is exactly the score viterbi() reports, whatever symbol is in the start column.
+        """
+
+        encoded = self.encode(sequence)         # once, however many paths there are
+        return self.score_pairs([encoded] * len(paths), paths, null_state)
+
+    def score_pairs(self, sequences, paths, null_state='I'):
+
+        """Score many (sequence, path) pairs in one pass; returns (log_probs, log_odds) as for score_paths.
+
+        All of the pairs are laid end to end in one long array, so the emission and transition scores of every residue
+        are gathered with a single fancy-indexing operation each. Transitions that would straddle two pairs are zeroed
+        out, and an add.reduceat over the pair boundaries gives each pair its own total.
+        """
+
+        encoded_sequences = [self.encode(sequence) for sequence in sequences]
+        encoded_paths = [self.encode_path(path) for path in paths]
+        for sequence, path in zip(encoded_sequences, encoded_paths):
+            if len(sequence) != len(path):
+                raise ValueError('A path of length {} cannot label a sequence of length {}'.format(len(path),
+                                                                                                  len(sequence)))
+        if not encoded_sequences:
+            return np.zeros(0), np.zeros(0)
+        if not all(len(sequence) for sequence in encoded_sequences):
+            raise ValueError('Cannot score an empty sequence')
+
+        lengths = np.array([len(sequence) for sequence in encoded_sequences])
+        starts = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+        symbols = np.concatenate(encoded_sequences)
+        states = np.concatenate(encoded_paths)
+
+        def totals(state_array):
+            position_scores = self.log_emissions[state_array, symbols]
+            position_scores[starts] = 0                 # the start column of each pair emits nothing
+            transition_scores = self.log_transitions[state_array[:-1], state_array[1:]]
+            transition_scores[starts[1:] - 1] = 0       # from the end of one pair into the start of the next
+            position_scores[1:] += transition_scores
+            return np.add.reduceat(position_scores, starts)
+
+        log_probs = totals(states)
+
+        null_states = np.full(len(symbols), self.state_index[null_state], dtype=np.intp)
+        null_states[starts] = self.start
+        with np.errstate(invalid='ignore'):         # -inf - -inf, for a sequence that is impossible either way
+            log_odds = log_probs - totals(null_states)
+
+        return log_probs, log_odds
+
+    def viterbi_batch(self, sequences, bucket_width=32, max_batch_size=256, as_segments=False, sparse=None):
+
+        """Viterbi decoding of many sequences at once. Returns a list of (log_prob, path) tuples in the same order as
+        sequences, each identical to what viterbi() would give for that sequence alone.
+
+        To keep padding waste down, the sequences are first sorted by length and cut into buckets whose lengths differ
+        by no more than bucket_width (and that hold no more than max_batch_size sequences). Each bucket is then padded
+        out to its longest member and decoded as one (sequences x states) array per position, with a mask that freezes
+        a sequence's column once we run past its end. as_segments and sparse work as for viterbi().
+        """
+
+        results = [None] * len(sequences)
+        encoded = [self.encode(sequence) for sequence in sequences]
+        step = self._sparse_batch_step if (self.sparse_batch if sparse is None else sparse) else self._batch_step
+
+        for bucket in self._length_buckets([len(e) for e in encoded], bucket_width, max_batch_size):
+            bucket_results = self._viterbi_bucket([encoded[i] for i in bucket], step, as_segments)
+            for i, result in zip(bucket, bucket_results):
+                results[i] = result
+
+        return results
+
+    @staticmethod
+    def _length_buckets(lengths, bucket_width, max_batch_size):
+
+        """Group sequence indices into buckets of similar length, shortest first"""
+
+        order = sorted(range(len(lengths)), key=lambda i: lengths[i])
+        buckets = []
+        bucket = []
+
+        for i in order:
+            if bucket and (lengths[i] - lengths[bucket[0]] > bucket_width or len(bucket) >= max_batch_size):
+                buckets.append(bucket)
+                bucket = []
+            bucket.append(i)
+
+        if bucket:
+            buckets.append(bucket)
+
+        return buckets
+
+    def _viterbi_bucket(self, encoded_sequences, step, as_segments=False):
+
+        """Decode one padded bucket of encoded sequences with step (_batch_step or _sparse_batch_step), returning a list
+        of (log_prob, path) tuples
+        """
+
+        batch_size = len(encoded_sequences)
+        number_of_states = len(self.states)
+        lengths = np.array([len(e) for e in encoded_sequences])
+        max_length = max(lengths.max(), 1)
+
+        padded = np.full((batch_size, max_length), self.unknown_symbol, dtype=np.intp)     # padding is masked off below
+        for row, e in enumerate(encoded_sequences):
+            padded[row, :len(e)] = e
+
+        columns = np.full((batch_size, number_of_states), -np.inf, dtype=self.dtype)
+        columns[:, self.start] = 0
+
+        # Backpointers only need to hold a state index, so use the smallest integer type that can
+        backpointers = np.zeros((batch_size, max_length, number_of_states), dtype=np.min_scalar_type(number_of_states))
+
+        for position in range(1, max_length):
+            best, best_old_states = step(columns)
+            backpointers[:, position] = best_old_states
+            new_columns = best + self.log_emissions[:, padded[:, position]].T
+            active = (position < lengths)[:, np.newaxis]        # sequences that have already ended keep their column
+            columns = np.where(active, new_columns, columns)
+
+        # Vectorized traceback. Each sequence joins the traceback at its own last position.
+        final_states = columns.argmax(axis=1)
+        scores = columns[np.arange(batch_size), final_states]
+        paths = np.zeros((batch_size, max_length), dtype=np.intp)
+        current = final_states.copy()
+
+        for position in range(max_length - 1, -1, -1):
+            ending = lengths - 1 == position
+            current[ending] = final_states[ending]
+            paths[:, position] = current
+            if position:
+                current = backpointers[np.arange(batch_size), position, current].astype(np.intp)
+
+        return [(float(scores[row]), self._report(paths[row, :lengths[row]], as_segments))
+                if lengths[row] >= 2 else (0.0, self._report([self.start], as_segments))
+                for row in range(batch_size)]
+
+    def _batch_step(self, columns):
+
+        """The max over old states for a whole bucket of (batch x states) columns at once, over the dense matrix.
+        Returns (best, best_old_states), both (batch x states), before the emissions are added.
+        """
+
+        candidates = columns[:, :, np.newaxis] + self.log_transitions      # (batch, old state k, new state l)
+        best_old_states = candidates.argmax(axis=1)
+        return np.take_along_axis(candidates, best_old_states[:, np.newaxis, :], axis=1)[:, 0], best_old_states
+
+    def _sparse_batch_step(self, columns):
+
+        """The same as _batch_step over the legal transitions only, as _sparse_viterbi_step does it for one column: a
+        (batch x edges) array of candidates instead of a (batch x states x states) one.
+        """
+
+        candidates = columns[:, self.edge_sources] + self.edge_log_transitions       # (batch, edge)
+        best = np.full(columns.shape, -np.inf, dtype=self.dtype)
+        best[:, self.reachable_states] = np.maximum.reduceat(candidates, self.edge_starts, axis=1)
+
+        # The first edge of each destination's group that attains its maximum (the argmax tie-break of the dense step)
+        number_of_edges = len(self.edge_sources)
+        edge_numbers = np.where(candidates == best[:, self.edge_destinations], np.arange(number_of_edges),
+                                number_of_edges)
+        first_winners = np.minimum.reduceat(edge_numbers, self.edge_starts, axis=1)
+        best_old_states = np.zeros(columns.shape, dtype=np.intp)     # unreachable states point at state 0, as dense
+        best_old_states[:, self.reachable_states] = self.edge_sources[first_winners]
+
+        return best, best_old_states
+
+    def forward(self, sequence):
+
+        """Log-space forward algorithm. The recursion is the Viterbi one with max replaced by a (log) sum, so the result
+        is the total likelihood of the sequence summed over every possible state path, rather than the score of the
+        single best one. Returns (log_likelihood, log_alpha) where log_alpha[t, l] is the log probability of the first
+        t+1 symbols with the path ending in state l.
+        """
+
+        encoded = self.encode(sequence)
+        length = max(len(encoded), 1)
+        emission_columns = self.log_emissions[:, encoded].T
+
+        log_alpha = np.full((length, len(self.states)), -np.inf, dtype=self.dtype)
+        log_alpha[0, self.start] = 0        # the start column, exactly as in viterbi()
+
+        # The log-sum-exp over old states is done as a matrix-vector product against the plain transition matrix, after
+        # shifting the previous column by its maximum so that nothing underflows
+        with np.errstate(divide='ignore'):
+            for position in range(1, length):
+                peak = log_alpha[position - 1].max()
+                if peak == -np.inf:             # the sequence has become impossible (e.g. an unknown symbol)
+                    break
+                log_alpha[position] = np.log(np.exp(log_alpha[position - 1] - peak) @ self.transitions) + peak + \
+                                      emission_columns[position]
+
+        return float(log_sum_exp(log_alpha[-1])), log_alpha
+
+    def backward(self, sequence):
+
+        """Log-space backward algorithm. Returns (log_likelihood, log_beta) where log_beta[t, k] is the log probability
+        of the symbols after position t given that the path is in state k at t. The likelihood agrees with forward().
+        """
+
+        encoded = self.encode(sequence)
+        length = max(len(encoded), 1)
+        emission_columns = self.log_emissions[:, encoded].T
+
+        log_beta = np.zeros((length, len(self.states)), dtype=self.dtype)  # no end state, so any state may finish
+
+        with np.errstate(divide='ignore'):
+            for position in range(length - 2, -1, -1):
+                following = emission_columns[position + 1] + log_beta[position + 1]
+                peak = following.max()
+                if peak == -np.inf:
+                    log_beta[:position + 1] = -np.inf
+                    break
+                log_beta[position] = np.log(self.transitions @ np.exp(following - peak)) + peak
+
+        return float(log_beta[0, self.start]), log_beta
+
+    def forward_scaled(self, sequence):
+
+        """The forward algorithm in plain (non-log) probabilities, with every column rescaled to sum to one so that
+        nothing underflows. This avoids all of the exp / log work of forward(), and in float32 (see as_dtype) halves
+        the table again. Returns (log_likelihood, alpha, scales): alpha[t] is the scaled forward column, scales[t] the
+        factor it was divided by, and the log likelihood is the sum of the logs of the scales (accumulated in float64).
+
+        Against the float64 log-space forward() on 160_membrane_prots.txt, the float64 scaled likelihood agrees to a
+        relative error of 1e-13 and the float32 one to 1e-7; float32 posteriors built from it agree to within 1e-5
+        absolute (float64 ones to 1e-9).
+        """
+
+        encoded = self.encode(sequence)
+        length = max(len(encoded), 1)
+        emission_columns = np.exp(self.log_emissions[:, encoded].T)
+
+        alpha = np.zeros((length, len(self.states)), dtype=self.dtype)
+        alpha[0, self.start] = 1
+        scales = np.ones(length, dtype=self.dtype)
+
+        for position in range(1, length):
+            column = (alpha[position - 1] @ self.transitions) * emission_columns[position]
+            scales[position] = column.sum()
+            if scales[position] == 0:       # the sequence has become impossible
+                return -np.inf, alpha, scales
+            alpha[position] = column / scales[position]
+
+        return float(np.log(scales.astype(np.float64)).sum()), alpha, scales
+
+    def backward_scaled(self, sequence, scales):
+
+        """The backward algorithm in plain probabilities, scaled by the same factors forward_scaled() returned, so that
+        alpha[t] * beta[t] is directly the posterior at t.
+        """
+
+        encoded = self.encode(sequence)
+        length = max(len(encoded), 1)
+        emission_columns = np.exp(self.log_emissions[:, encoded].T)
+
+        beta = np.ones((length, len(self.states)), dtype=self.dtype)
+        for position in range(length - 2, -1, -1):
+            beta[position] = (self.transitions @ (emission_columns[position + 1] * beta[position + 1])) / \
+                             scales[position + 1]
+
+        return beta
+
+    def posterior(self, sequence, scaled=False):
+
+        """Posterior decoding. Returns (log_likelihood, posteriors, path) where posteriors[t, l] is the probability
+        that position t was emitted by state l given the whole sequence, and path is the list of most probable states
+        position by position (which, unlike the Viterbi path, need not be a legal path through the model). With scaled
+        the computation uses forward_scaled / backward_scaled instead of the log-space recursions.
+        """
+
+        if scaled:
+            log_likelihood, alpha, scales = self.forward_scaled(sequence)
+            if log_likelihood == -np.inf:
+                return log_likelihood, np.full(alpha.shape, np.nan), self.decode_states(alpha.argmax(axis=1))
+            posteriors = alpha * self.backward_scaled(sequence, scales)
+        else:
+            log_likelihood, log_alpha = self.forward(sequence)
+            log_beta = self.backward(sequence)[1]
+            posteriors = np.exp(log_alpha + log_beta - log_likelihood)
+
+        return log_likelihood, posteriors, self.decode_states(posteriors.argmax(axis=1))
+
+    def with_tables(self, log_transitions, log_emissions, dtype=np.float64):
+
+        """A copy of this model with new log transition and emission matrices (same states, alphabet and start)"""
+
+        model = copy(self)
+        object.__setattr__(model, '_frozen', False)
+        model.log_transitions = np.array(log_transitions, dtype=dtype)
+        model.transitions = np.exp(model.log_transitions)
+        model.log_emissions = model._with_background(np.array(log_emissions, dtype=dtype))
+        model.dtype = model.log_transitions.dtype
+        model._compile_predecessors()
+        model._freeze()
+        return model
+
+    def as_dtype(self, dtype):
+
+        """A copy of this model whose tables, and therefore every DP table built while decoding with it, use dtype.
+
+        as_dtype(np.float32) halves the memory of the Viterbi / forward tables (which dominate for batched decoding) and
+        doubles the number of values per SIMD operation. Measured against the float64 model on the 160 sequences of
+        160_membrane_prots.txt (read with FastA_V2.AnnotatedFastA, so residues only, without the '#' labels: the longest
+        is 1827 residues), float32 Viterbi scores agree to within a relative error of 2e-5 and every path is identical;
+        the error grows roughly linearly with length (about 1.5e-8 per residue), and paths can only differ where two of
+        them score within that tolerance of each other. float32 log-space forward likelihoods agree to within 1e-5
+        relative.
+        """
+
+        return self.with_tables(self.log_transitions, self.log_emissions, dtype)
+
+    def to_dicts(self):
+
+        """The model as plain probability dict-of-dicts (transitions, emissions), in the same layout as the acid_dict
+        pickle and TMM_HMM_dicts.emissions. Impossible transitions and emissions are left out, as they are there.
+        """
+
+        transitions = {old_state_k: {new_state_l: float(self.transitions[k, l])
+                                     for l, new_state_l in enumerate(self.states) if self.transitions[k, l] > 0}
+                       for k, old_state_k in enumerate(self.states)}
+        emissions = {state: {symbol: float(np.exp(self.log_emissions[k, c]))
+                             for c, symbol in enumerate(self.alphabet) if self.log_emissions[k, c] > -np.inf}
+                     for k, state in enumerate(self.states)}
+        return transitions, emissions
+
+
+class StreamingViterbi(object):
+    """StreamingViterbi
+    Fixed-lag online Viterbi decoding for input that is too long (or arrives too slowly) to be decoded as a whole.
+
+    Residues are fed in as they arrive, in chunks of any size, and state labels come back out as soon as they are
+    certain: whenever every surviving path (every state that is still possible at the newest position) traces back
+    through the same state at some earlier position, the whole path up to that point can no longer change, and it is
+    emitted. If the paths have not coalesced within lag positions, the oldest positions are decided anyway from the
+    currently best path, so memory never holds more than about lag backpointer rows. Labels that were only decided
+    because the lag ran out can, rarely, differ from what full Viterbi would have chosen.
+
+    As with CompiledHMM.viterbi, position 0 belongs to the start state, so the residues fed in are positions 1, 2, ...
+    and should not include the leading '_' placeholder. Concatenating everything returned by feed() and finish() gives
+    the same path as model.viterbi('_' + sequence)[1] whenever the lag was never exceeded.
+    """
+
+    def __init__(self, model, lag=1000, check_interval=None, sparse=None):
+
+        self.model = model
+        self.lag = lag
+        self.check_interval = check_interval or max(1, lag // 8)    # how often to look for coalescence
+        self.step = model._step_function(sparse)
+
+        self.column = np.full(len(model.states), -np.inf, dtype=model.dtype)
+        self.column[model.start] = 0
+        self.position = 0           # the newest position we have a Viterbi column for
+        self.emitted = 0            # positions before this have been emitted
+        self.backpointers = deque()     # backpointer rows for positions emitted + 1 .. position
+        self.log_prob = None        # the score of the best complete path, once finish() has been called
+
+    def feed(self, residues):
+
+        """Consume a chunk of residues; return the list of state labels that have become certain as a result"""
+
+        decided = []
+        for symbol in self.model.encode(residues):
+            self.column, best_old_states = self.step(self.column, self.model.log_emissions[:, symbol])
+            self.backpointers.append(best_old_states)
+            self.position += 1
+
+            if self.position % self.check_interval == 0:
+                decided += self._emit_coalesced()
+            if self.position - self.emitted >= self.lag:
+                decided += self._emit_through(self.position - self.lag, self.column.argmax())
+
+        return decided
+
+    def finish(self):
+
+        """Signal the end of the input; return the remaining labels, and set log_prob to the best path's score"""
+
+        best = self.column.argmax()
+        self.log_prob = float(self.column[best])
+        return self._emit_through(self.position, best)
+
+    def _emit_coalesced(self):
+
+        """Emit the path up to the most recent position at which all surviving paths agree, if there is one"""
+
+        survivors = np.flatnonzero(self.column > -np.inf)
+        if not len(survivors):
+            return []
+
+        for position in range(self.position, self.emitted, -1):
+            if len(np.unique(survivors)) == 1:
+                return self._emit_through(position, survivors[0], state_position=position)
+            survivors = self.backpointers[position - self.emitted - 1][survivors]
+
+        if len(np.unique(survivors)) == 1:
+            return self._emit_through(self.emitted, survivors[0], state_position=self.emitted)
+        return []
+
+    def _emit_through(self, last, state, state_position=None):
+
+        """Emit positions self.emitted .. last, given that the path is in state at state_position (by default the
+        newest position), and drop the backpointers that are no longer needed.
+        """
+
+        if state_position is None:
+            state_position = self.position
+
+        path = [state]
+        for position in range(state_position, self.emitted, -1):
+            state = self.backpointers[position - self.emitted - 1][state]
+            path.append(state)
+        path.reverse()                              # path[i] is now the state at position self.emitted + i
+
+        for _ in range(min(last + 1 - self.emitted, len(self.backpointers))):
+            self.backpointers.popleft()
+        path = path[:last + 1 - self.emitted]
+        self.emitted = last + 1
+
+        return self.model.decode_states(path)
+
+
+def decode_stream(model, chunks, lag=1000):
+
+    """Decode an iterable of residue chunks (e.g. a generator reading a huge file piece by piece) with a
+    StreamingViterbi, yielding the state labels as strings as soon as they are decided.
+    """
+
+    decoder = StreamingViterbi(model, lag)
+    for chunk in chunks:
+        labels = decoder.feed(chunk)
+        if labels:
+            yield ''.join(labels)
+    yield ''.join(decoder.finish())
+
+
+def main(fasta_path='160_membrane_prots.txt'):
+
+    """Check that the path scorer and the decoders agree: for every record, with and without the '_' placeholder in its
+    start column, score_paths on the Viterbi path must give back exactly the Viterbi score
+    """
+
+    model = load_compiled_model()
+    mismatches = 0
+    checked = 0
+    for annotation, sequence, labels in FastA_V2.AnnotatedFastA(fasta_path, strict=False):
+        for candidate in (sequence, '_' + sequence):
+            score, path = model.viterbi(candidate)
+            if not math.isclose(model.score_paths(candidate, [path])[0][0], score, rel_tol=1e-12):
+                mismatches += 1
+                print('Scores differ for', annotation)
+            checked += 1
+    print(checked, 'Viterbi paths rescored,', mismatches, 'mismatches')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,259 @@
+__author__ = 'Wombat'
+
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from os import cpu_count
+from time import perf_counter
+import asyncio
+import json
+import math
+import Chris_FastHMM
+from FastA_V2 import AnnotatedFastA
+
+
+def decode_batch(model_path, sequences):
+
+    """Decode a micro-batch in a worker. The model is loaded once per worker process (load_compiled_model caches it),
+    and the whole batch goes through the batched Viterbi engine and one batched scoring pass. Returns a list of
+    (topology, viterbi_score, log_odds) tuples, where topology labels the residues only (no start state) and log_odds
+    is against the all-I fake path, as in the Chris_MiniHMM.py driver.
+    """
+
+    model = Chris_FastHMM.load_compiled_model(model_path)
+    acids = ['_' + sequence for sequence in sequences]
+    decoded = model.viterbi_batch(acids)
+    log_odds = model.score_pairs(acids, [path for score, path in decoded])[1]
+    return [(''.join(path[1:]), score, float(odds)) for (score, path), odds in zip(decoded, log_odds)]
+
+
+def clean_sequence(sequence):
+
+    """A request's sequence, stripped and upper-cased, or ValueError naming the first character that is not a residue
+    code (an ASCII letter). Checked before a sequence is queued, so that one bad request can't fail its whole batch.
+    Letters outside the model's alphabet, like X, are fine (see Chris_FastHMM.CompiledHMM).
+    """
+
+    if not isinstance(sequence, str):
+        raise TypeError('sequence must be a string, not {}'.format(type(sequence).__name__))
+    sequence = sequence.strip()
+    for residue in sequence:
+        if not (residue.isascii() and residue.isalpha()):
+            raise ValueError('{!r} is not a residue code'.format(residue))
+    return sequence.upper()
+
+
+def finite_or_none(score):
+
+    """score, or None (JSON null) for -inf or nan, which JSON has no standard way of writing"""
+
+    return score if math.isfinite(score) else None
+
+
+class DecodingService(object):
+    """DecodingService
+    A local asyncio server that keeps a compiled TMM model hot and decodes sequences for any number of clients, so a
+    job no longer pays for Python start-up and model loading every time.
+
+    The protocol is one JSON object per line, in both directions, over TCP (host, port) or a Unix socket (path):
+
+        request     {"id": <anything>, "sequence": "MKV..."}
+        response    {"id": <same>, "topology": "IIIMMM...", "viterbi": -123.4, "log_odds": 5.6}
+                    or {"id": <same>, "error": "..."}
+
+    A sequence may only hold letters, and is rejected on its own otherwise. A score that is not finite (a sequence the
+    model cannot produce at all) is sent as null.
+
+    A client may pipeline as many requests as it likes on one connection; responses come back as they finish, so match
+    them up by id. Incoming sequences go onto a queue, and a batcher task groups them into micro-batches, which close as
+    soon as they hold max_batch_size sequences or max_delay seconds after their first sequence arrived, whichever comes
+    first. Each batch is decoded in a worker pool (processes by default, threads if asked), with up to one batch in
+    flight per worker.
+    """
+
+    def __init__(self, model_path='acid_dict', max_batch_size=64, max_delay=0.005, workers=None, use_threads=False):
+
+        self.model_path = model_path
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay
+        self.workers = workers or cpu_count() or 1
+        self.use_threads = use_threads
+
+        self.queue = None           # created on start(), as it must belong to the running event loop
+        self.server = None
+        self.executor = None
+        self.batcher = None
+        self.batches = 0            # how many batches, and sequences, have been decoded so far
+        self.sequences = 0
+
+    async def start(self, host='127.0.0.1', port=0, path=None):
+
+        """Start listening (port=0 picks a free port). Returns the address actually bound."""
+
+        pool = ThreadPoolExecutor if self.use_threads else ProcessPoolExecutor
+        self.executor = pool(self.workers)
+        # Warm every worker up front, so that the first real requests don't pay for loading the model
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(*(loop.run_in_executor(self.executor, decode_batch, self.model_path, ['A'])
+                               for _ in range(self.workers)))
+
+        self.queue = asyncio.Queue()
+        self.batcher = asyncio.create_task(self._batch_loop())
+
+        if path:
+            self.server = await asyncio.start_unix_server(self._handle_connection, path=path)
+            return path
+        self.server = await asyncio.start_server(self._handle_connection, host, port)
+        return self.server.sockets[0].getsockname()[:2]
+
+    async def stop(self):
+
+        self.server.close()
+        await self.server.wait_closed()
+        self.batcher.cancel()
+        self.executor.shutdown()
+
+    async def decode(self, sequence):
+
+        """Check one sequence (see clean_sequence), queue it and wait for its (topology, viterbi_score, log_odds)"""
+
+        sequence = clean_sequence(sequence)
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((sequence, future))
+        return await future
+
+    async def _handle_connection(self, reader, writer):
+
+        pending = set()
+
+        async def answer(line):
+            request = None
+            try:
+                request = json.loads(line)
+                topology, score, log_odds = await self.decode(request['sequence'])
+                response = {'id': request.get('id'), 'topology': topology, 'viterbi': finite_or_none(score),
+                            'log_odds': finite_or_none(log_odds)}
+            except Exception as error:      # a bad request, or a failed batch (BrokenProcessPool ...): still answer
+                response = {'id': request.get('id') if isinstance(request, dict) else None, 'error': repr(error)}
+            try:
+                writer.write(json.dumps(response).encode() + b'\n')
+                await writer.drain()        # don't buffer without bound for a client that isn't reading
+            except ConnectionError:
+                pass
+
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            task = asyncio.create_task(answer(line))
+            pending.add(task)
+            task.add_done_callback(pending.discard)
+
+        if pending:
+            await asyncio.wait(pending)
+        try:
+            await writer.drain()
+            writer.close()
+            await writer.wait_closed()
+        except ConnectionError:
+            pass
+
+    async def _batch_loop(self):
+
+        loop = asyncio.get_running_loop()
+        in_flight = asyncio.Semaphore(self.workers)
+
+        while True:
+            batch = [await self.queue.get()]        # a batch opens with its first sequence...
+            deadline = loop.time() + self.max_delay
+            while len(batch) < self.max_batch_size:     # ...and closes when full, or when the deadline passes
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            await in_flight.acquire()
+            asyncio.create_task(self._run_batch(batch, in_flight))
+
+    async def _run_batch(self, batch, in_flight):
+
+        loop = asyncio.get_running_loop()
+        try:
+            results = await loop.run_in_executor(self.executor, decode_batch, self.model_path,
+                                                 [sequence for sequence, future in batch])
+            for (sequence, future), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+            self.batches += 1
+            self.sequences += len(batch)
+        except Exception as error:          # don't leave any client waiting forever
+            for sequence, future in batch:
+                if not future.done():
+                    future.set_exception(error)
+        finally:
+            in_flight.release()
+
+
+async def run_load(address, sequences, concurrency=8, requests=1000):
+
+    """A load generator: concurrency connections, each sending its share of requests (cycling through sequences) one at
+    a time and timing each round trip. Returns a report dict with throughput and latency percentiles in milliseconds.
+    """
+
+    latencies = []
+
+    async def client(client_number):
+        if isinstance(address, str):
+            reader, writer = await asyncio.open_unix_connection(address)
+        else:
+            reader, writer = await asyncio.open_connection(*address)
+        for request_number in range(client_number, requests, concurrency):
+            sequence = sequences[request_number % len(sequences)]
+            started = perf_counter()
+            writer.write(json.dumps({'id': request_number, 'sequence': sequence}).encode() + b'\n')
+            await writer.drain()
+            response = json.loads(await reader.readline())
+            latencies.append(perf_counter() - started)
+            if 'error' in response:
+                raise RuntimeError(response['error'])
+        writer.close()
+        await writer.wait_closed()
+
+    started = perf_counter()
+    await asyncio.gather(*(client(i) for i in range(concurrency)))
+    elapsed = perf_counter() - started
+
+    latencies.sort()
+
+    def percentile(p):
+        return 1000 * latencies[min(len(latencies) - 1, int(p / 100 * len(latencies)))]
+
+    return {'requests': len(latencies), 'seconds': elapsed, 'throughput': len(latencies) / elapsed,
+            'p50_ms': percentile(50), 'p90_ms': percentile(90), 'p99_ms': percentile(99),
+            'max_ms': 1000 * latencies[-1]}
+
+
+async def demo(fasta_path='160_membrane_prots.txt', concurrency=16, requests=2000):
+
+    """Start a service on a free localhost port, hammer it with the load generator, report, and shut it down"""
+
+    sequences = [acid for annotation, acid, labels in AnnotatedFastA(fasta_path, strict=False)]
+    service = DecodingService()
+    address = await service.start()
+    print('Decoding service listening on', address)
+
+    report = await run_load(address, sequences, concurrency, requests)
+    print(report)
+    print('Decoded', service.sequences, 'sequences in', service.batches, 'batches')
+
+    await service.stop()
+
+
+def main():
+
+    asyncio.run(demo())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,194 @@
+"""Chris_HigherOrderHMM
+Decoding and training of order-k topology models, where the next state depends on the last k states, not just one.
+
+An order-k chain over the base states (S, I, M, O) is the same thing as a first-order chain over k-mers of them: the
+state at each position is the history of the last k base states, a k-mer can only move to the k-mers that extend it by
+one state (so 'IMM' -> 'MMM' or 'MMO', never anything else), and every k-mer emits with the emissions of its newest
+base state. That is exactly how Hamlet(order=k) already counts its stems and predictions, so its model dict can be
+compiled as it is.
+
+The expanded state space is built straight into index-encoded edge arrays (source k-mer, destination k-mer, log
+probability) and handed to a CompiledHMM. Since each k-mer has at most one successor per base state, only a small
+fraction of k-mer pairs are legal. Once there are enough k-mers for it to pay (see Chris_FastHMM.SPARSE_MIN_STATES and
+SPARSE_BATCH_MIN_STATES), the CompiledHMM decodes over its sparse edge lists, single sequences and batches alike, so
+the cost per residue grows with the number of k-mer edges actually observed rather than with the square of the number
+of k-mers; below that (the 25 k-mers of order 4 on the membrane set, say) the dense step is the faster one and is used
+instead. Either way the result is the same, and viterbi / viterbi_batch take sparse= to force one or the other.
+
+Training (train) counts the expected transitions over the edges only as well, but its forward and backward passes are
+dense matrix-vector products over the k-mers.
+"""
+
+__author__ = 'Wombat'
+
+from time import perf_counter
+import math
+import numpy as np
+import TMM_HMM_dicts
+from Chris_BaumWelch import BaumWelch
+from Chris_FastHMM import CompiledHMM
+from Chris_MakeMarkov_TMM import Hamlet
+from Chris_TopologyStore import path_segments
+from FastA_V2 import AnnotatedFastA
+
+
+class HigherOrderHMM(object):
+    """HigherOrderHMM
+    An order-k HMM, compiled to a first-order CompiledHMM over k-mer states (kept in self.model). Every method takes and
+    returns paths of base states, with the usual conventions (the path begins with the start state, and the first
+    position of the sequence is the start column), so an order-k model is a drop-in replacement for the order-1 one.
+    """
+
+    def __init__(self, transitions, emissions, order, start_symbol='S'):
+
+        """transitions is a Hamlet model dict for this order: k-mer stems -> {k-mer prediction: probability}. Any
+        stem + sum_symbol entries are ignored. emissions is keyed by base state, as TMM_HMM_dicts.emissions is.
+        """
+
+        self.order = order
+        self.start_symbol = start_symbol
+        self.start_kmer = start_symbol * order
+
+        edges = [(stem, prediction, probability) for stem, predictions in transitions.items()
+                 if isinstance(predictions, dict) for prediction, probability in predictions.items() if probability > 0]
+        kmers = sorted({self.start_kmer} | {stem for stem, prediction, p in edges} |
+                       {prediction for stem, prediction, p in edges})
+        for kmer in kmers:
+            if len(kmer) != order:
+                raise ValueError('{!r} is not a state history of order {}'.format(kmer, order))
+        kmer_index = {kmer: i for i, kmer in enumerate(kmers)}
+
+        # The expanded transition structure, index-encoded: one entry per legal (k-mer, k-mer) edge
+        sources = np.array([kmer_index[stem] for stem, prediction, p in edges], dtype=np.intp)
+        destinations = np.array([kmer_index[prediction] for stem, prediction, p in edges], dtype=np.intp)
+        log_probs = np.log(np.array([p for stem, prediction, p in edges], dtype=np.float64))
+
+        log_transitions = np.full((len(kmers), len(kmers)), -np.inf)
+        log_transitions[sources, destinations] = log_probs
+
+        # Each k-mer emits as its newest base state does, so the k-mer emission table is a row gather
+        base_states = sorted(emissions)
+        alphabet = sorted({symbol for emits in emissions.values() for symbol in emits})
+        base_emissions = np.full((len(base_states), len(alphabet) + 1), -np.inf)
+        for i, state in enumerate(base_states):
+            for symbol, probability in emissions[state].items():
+                base_emissions[i, alphabet.index(symbol)] = math.log(probability)
+        base_index = {state: i for i, state in enumerate(base_states)}
+
+        # emission_groups[i] is the base state k-mer i emits as, which is also what ties their emissions in training
+        self.base_states = tuple(base_states)
+        self.emission_groups = np.array([base_index[kmer[-1]] for kmer in kmers], dtype=np.intp)
+        self.model = CompiledHMM.from_arrays(kmers, alphabet, log_transitions, base_emissions[self.emission_groups],
+                                             self.start_kmer)
+
+    @classmethod
+    def from_hamlet(cls, hamlet, emissions=None):
+
+        """Compile the transition counts a Hamlet of any order has estimated, with TMM_HMM_dicts emissions by default"""
+
+        transitions = {stem: predictions for stem, predictions in hamlet.model.items()
+                       if not stem.endswith(hamlet.sum_symbol)}
+        return cls(transitions, emissions or TMM_HMM_dicts.emissions, hamlet.order)
+
+    def _with_model(self, model):
+
+        copy = self.__class__.__new__(self.__class__)
+        copy.__dict__.update(self.__dict__)
+        copy.model = model
+        return copy
+
+    def base_path(self, kmer_path):
+
+        """A path of k-mer states (names or indices) as the path of base states it encodes"""
+
+        return [kmer[-1] for kmer in (self.model.decode_states(kmer_path) if isinstance(kmer_path, np.ndarray)
+                                      else kmer_path)]
+
+    def expand_path(self, path):
+
+        """The inverse of base_path: a path of base states (starting with the start state) as k-mer state indices.
+        The k-mer at each position is the last k base states, padded on the left with the start state.
+        """
+
+        padded = self.start_symbol * (self.order - 1) + ''.join(path)
+        return self.model.encode_path([padded[i:i + self.order] for i in range(len(path))])
+
+    def viterbi(self, sequence, as_segments=False, sparse=None):
+
+        """Viterbi decoding, as CompiledHMM.viterbi, with the path given in base states"""
+
+        log_prob, path = self.model.viterbi(sequence, sparse)
+        path = self.base_path(path)
+        return log_prob, path_segments(path) if as_segments else path
+
+    def viterbi_batch(self, sequences, as_segments=False, sparse=None):
+
+        results = []
+        for log_prob, path in self.model.viterbi_batch(sequences, sparse=sparse):
+            path = self.base_path(path)
+            results.append((log_prob, path_segments(path) if as_segments else path))
+        return results
+
+    def forward(self, sequence):
+
+        return self.model.forward(sequence)
+
+    def score_pairs(self, sequences, paths, null_state='I'):
+
+        """As CompiledHMM.score_pairs, with base state paths (the null path is all null_state after the start)"""
+
+        expanded = [self.expand_path(path) for path in paths]
+        null_paths = [self.expand_path(self.start_symbol + null_state * (len(path) - 1)) for path in paths]
+        # The k-mer model has no single null state, so both paths are scored as given and the log-odds taken here
+        log_probs = self.model.score_pairs(sequences, expanded, self.start_kmer)[0]
+        null_log_probs = self.model.score_pairs(sequences, null_paths, self.start_kmer)[0]
+        with np.errstate(invalid='ignore'):
+            return log_probs, log_probs - null_log_probs
+
+    def train(self, records, processes=None, **options):
+
+        """Baum-Welch re-estimation of the k-mer transitions and the (base state) emissions. records is a list of
+        (sequence, labels) pairs as for BaumWelch.train, with labels, where given, in base states. The emissions of all
+        k-mers ending in the same base state are tied, so the model keeps one emission distribution per base state.
+        Returns the trained HigherOrderHMM.
+        """
+
+        expanded = [(sequence, None if labels is None else self.expand_path(labels)) for sequence, labels in records]
+        trainer = BaumWelch(self.model, processes, tied_emissions=self.emission_groups)
+        return self._with_model(trainer.train(expanded, **options))
+
+    def stats(self):
+
+        number_of_states = len(self.model.states)
+        return {'order': self.order, 'states': number_of_states, 'edges': len(self.model.edge_sources),
+                'density': len(self.model.edge_sources) / number_of_states ** 2, 'sparse': self.model.sparse,
+                'sparse_batch': self.model.sparse_batch}
+
+
+def main(file_path='160_membrane_prots.txt', orders=(1, 2, 3, 4)):
+
+    """Fit models of increasing order to the labeled records (as Hamlet does) and decode the ECOLI records with each,
+    reporting the size of the expanded state space, decoding time and per-residue agreement with the annotation.
+    """
+
+    records = []
+    for annotation, acid, labels in AnnotatedFastA(file_path):
+        if 'ECOLI' in annotation and labels is not None:
+            records.append(("_" + acid, "S" + labels))
+    sequences = [sequence for sequence, labels in records]
+
+    for order in orders:
+        hmm = HigherOrderHMM.from_hamlet(Hamlet(file_path, order))
+        started = perf_counter()
+        decoded = hmm.viterbi_batch(sequences)
+        elapsed = perf_counter() - started
+
+        correct = sum(sum(a == b for a, b in zip(path[1:], labels[1:])) for (score, path), (s, labels)
+                      in zip(decoded, records))
+        total = sum(len(labels) - 1 for sequence, labels in records)
+        print('Order', order, hmm.stats(), 'decoded in {:.3f}s'.format(elapsed),
+              'Q accuracy {:.4f}'.format(correct / total))
+
+
+if __name__ == '__main__':
+    main()
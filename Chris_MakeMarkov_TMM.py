@@ -1,8 +1,11 @@
 from pickle import dump
 from random import random
 from textwrap import fill
-from FastA_V2 import FastA
-import re
+from FastA_V2 import AnnotatedFastA
+import TMM_HMM_dicts
+import Chris_FastHMM
+import Chris_ModelFile
+import FastA_Shards
 
 __author__ = 'Wombat'
 
@@ -22,7 +25,7 @@ class Hamlet(object):
             a Python pickle file containing a binary serialization of the key transition dict.
     """
 
-    def __init__(self, filepath=None, order=1):
+    def __init__(self, filepath=None, order=1, workers=None):
 
         self.sum_symbol = '|'  # A special symbol used in the keys of the main model dict to indicate a sum for a stem
         start_symbol = 'S'  # All path actually begin with this special symbol
@@ -54,15 +57,20 @@ class Hamlet(object):
         else:  # A speech file has been specified, read it in utterance by utterance
 
             print("Analysing", filepath)
-            sequence_object = FastA(filepath)
 
-            for annotation, line in sequence_object:
-                combine_no_space = re.sub(" ", "", line)
-                acid_state = combine_no_space.split("#")
-                state = acid_state[1]
-                if 'ECOLI' not in annotation:
-                    line = self.start_string + state  # + self.end_string
-                    self._determine_raw_counts(line)
+            if workers:  # count the byte-range shards of the file in parallel, then add the shards' counts together
+                sharded = FastA_Shards.ShardedFastA(filepath, annotated=True)
+                for counts in sharded.map(count_transitions, order, self.sum_symbol, workers=workers):
+                    self._add_counts(counts)
+
+            else:
+                sequence_object = AnnotatedFastA(filepath)   # (annotation, sequence, labels), lengths checked
+
+                for annotation, acid, labels in sequence_object:
+                    state = training_states(annotation, labels)
+                    if state is not None:
+                        line = self.start_string + state  # + self.end_string
+                        self._determine_raw_counts(line)
 
         # Now Convert the raw counts of each transition into frequencies.  As usual, we will be using these frequencies
         # as estimates of the underlying transition probabilities.
@@ -105,6 +113,18 @@ class Hamlet(object):
             self.model[stem][prediction] += 1  # Add one regardless of whether this was a new stem or
             self.model[stem + self.sum_symbol] += 1  # prediction, or something we had seen before
 
+    def _add_counts(self, counts):
+
+        """ Adds a dict of raw counts, as _determine_raw_counts builds them (e.g. for one shard of a file) into ours """
+
+        for stem, value in counts.items():
+            if stem[-1] == self.sum_symbol:
+                self.model[stem] = self.model.get(stem, 0) + value
+            else:
+                predictions = self.model.setdefault(stem, {})
+                for prediction, count in value.items():
+                    predictions[prediction] = predictions.get(prediction, 0) + count
+
     def make_speech(self, max_length=2500, characters_per_line=80):
 
         if not self.cumulative_model:
@@ -162,6 +182,47 @@ class Hamlet(object):
         print("We have pickled the dict to file", file_path)
         print(self.model)
 
+    def save_model_artifact(self, file_path='acid_dict' + Chris_ModelFile.SUFFIX):
+
+        """Write the model, together with the TMM_HMM_dicts emissions, as a pre-compiled binary artifact that decoders
+        can memory-map instead of unpickling (see Chris_ModelFile). Call after save_model, which drops the sum entries.
+        """
+
+        model = {key: val for key, val in self.model.items() if self.sum_symbol not in key}
+        compiled = Chris_FastHMM.CompiledHMM.from_probabilities(model, TMM_HMM_dicts.emissions)
+        Chris_ModelFile.save_model_artifact(compiled, file_path)
+
+
+def training_states(annotation, labels):
+
+    """The state path to train on from one record's labels, or None if the record is not used for training (it has no
+    labels, or is one of the ECOLI records held out for the Chris_MiniHMM.py driver to decode)
+    """
+
+    if labels is None or 'ECOLI' in annotation:
+        return None
+    return labels
+
+
+def count_transitions(records, order, sum_symbol='|'):
+
+    """The raw transition counts of one stream of (annotation, sequence, labels) records, in a worker process. Returns
+    the same dict-of-dicts (with stem sums) that Hamlet._determine_raw_counts builds, for Hamlet._add_counts to merge.
+    """
+
+    counter = Hamlet.__new__(Hamlet)      # just the counting state of a Hamlet, without reading any file
+    counter.order = order
+    counter.sum_symbol = sum_symbol
+    counter.model = {}
+    start_string = 'S' * order
+
+    for annotation, acid, labels in records:
+        state = training_states(annotation, labels)
+        if state is not None:
+            counter._determine_raw_counts(start_string + state)
+
+    return counter.model
+
 
 def main():
     my_speech_maker = Hamlet("160_membrane_prots.txt", 1)  # I should change the name of class but I think you still understand.
@@ -179,6 +240,7 @@ def main():
             make_another = False
 
     my_speech_maker.save_model()
+    my_speech_maker.save_model_artifact()
 
 
 if __name__ == '__main__':
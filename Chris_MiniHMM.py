@@ -3,16 +3,38 @@ __author__ = 'Wombat'
 import math
 import TMM_HMM_dicts
 import FastA_V2
-import re
+import Chris_FastHMM
+import Chris_DecodeCache
+from functools import lru_cache
 from pickle import load
 
 
+@lru_cache(maxsize=None)
+def load_model(file_path='acid_dict'):
+
+    """De-pickle our model dict and log-transform it. This only happens the first time it is called in a process, every
+    later HMM object shares the same (model, log_model) pair, so nothing here should ever be modified in place.
+    """
+
+    print("Loading model file", file_path)
+    with open(file_path, 'rb') as f:
+        model = load(f)
+    log_model = {outer_k: {inner_k: math.log(inner_v) for (inner_k, inner_v) in outer_v.items()} for
+                 (outer_k, outer_v) in model.items()}  # nested dict comprehension to log-transform
+    return model, log_model
+
+
+@lru_cache(maxsize=None)
+def _log_emissions():
+
+    return {outer_k: {inner_k: math.log(inner_v) for (inner_k, inner_v) in outer_v.items()} for
+            (outer_k, outer_v) in TMM_HMM_dicts.emissions.items()}
+
+
 class HMM(object):
 
     def __init__(self, sequence=None, states=None, emissions=None):
-        print("Loading model file", 'acid_dict')  # De-pickle our model dict, comment out to run with TMM_HMM_dicts.py
-        with open('acid_dict', 'rb') as f:
-            model = load(f)
+        model, log_model = load_model()  # comment out to run with TMM_HMM_dicts.py
         if sequence:
             self.observed_sequence = sequence.upper()  # Could optionally do some cleaning-up here of the sequence
         else:
@@ -23,8 +45,7 @@ class HMM(object):
         if states:
             # self.states = TMM_HMM_dicts.states
             self.states = model
-            self.log_states = {outer_k: {inner_k: math.log(inner_v) for (inner_k, inner_v) in outer_v.items()} for
-                               (outer_k, outer_v) in self.states.items()}  # nested dict comprehension to log-transform
+            self.log_states = log_model
 
         else:
             # The default here is a die-rolling occasionally dishonest casino
@@ -45,8 +66,7 @@ class HMM(object):
 
         if emissions:
             self.emissions = TMM_HMM_dicts.emissions
-            self.log_emissions = {outer_k: {inner_k: math.log(inner_v) for (inner_k, inner_v) in outer_v.items()} for
-                                  (outer_k, outer_v) in self.emissions.items()}
+            self.log_emissions = _log_emissions()
 
         else:
             #  Again, default to a die-rolling occasionally dishonest casino
@@ -176,91 +196,47 @@ class HMM(object):
 
 
 if __name__ == "__main__":
-    tuple_acid = FastA_V2.FastA("160_membrane_prots.txt")
-    # tuple_acid = FastA_V2.FastA("645_non_membrane_prots.txt.fasta")
-    my_states = {
-        "S": {
-            "+": 0.5,
-            "-": 0.5,
-        },
-        "+": {
-            "+": 0.85,
-            "-": 0.15,
-        },
-        "-": {
-            "-": 0.95,
-            "+": 0.05,
-        }
-    }
-
-    my_emissions = {
-
-        "S":
-            {
-                "_": 1
-            },
-        "-":
-            {
-                "A": 0.1,
-                "C": 0.40,
-                "G": 0.40,
-                "T": 0.1,
-
-            },
-        "+":
-            {
-                "A": 0.35,
-                "C": 0.20,
-                "G": 0.10,
-                "T": 0.35,
-            }
-    }
-
-    for annotation, combine in tuple_acid:
-        combine_no_space = re.sub(" ", "", combine)
-        # print(combine_no_space)
-        acid_state = combine_no_space.split("#")
-        acid = acid_state[0]
-        # try:
-        #     acid_state[1]
-        # except IndexError:
-        #     print('Actual path not given.')
-
-        # try:
-        #     acid_state = combine_no_space.split("#")
-        #
-        #     acid = acid_state[0]
-        # path = 'Y'
-
-        # except ValueError:
-        #     print('Actual path not given.')
-        #     acid = combine_no_space
-
-        # path = 'N'
+    tuple_acid = FastA_V2.AnnotatedFastA("160_membrane_prots.txt")
+    # tuple_acid = FastA_V2.AnnotatedFastA("645_non_membrane_prots.txt.fasta")
+    records = []  # (annotation, sequence, labels) for every protein we are going to decode
+
+    for annotation, acid, labels in tuple_acid:  # labels is the '#' topology annotation, or None if there isn't one
         acid = "_" + acid
-        if "ECOLI" in annotation:  # comment out this line and move the codes below it to correct indent for question 2i
-            my_HMM = HMM(acid, my_states, my_emissions)
-            probability_of_viterbi_decoded_state_path, viterbi_decoded_state_path = my_HMM.viterbi()
-            print(">" + annotation)
-            print('Sequence: ', acid)
-            fake_path = 'S' + 'I' * (len(acid) - 1)
-            # state_path = ''.join(viterbi_decoded_state_path)
-            # print("         ", state_path)
-            print('Viterbi:  ', ''.join(viterbi_decoded_state_path))
-            print("Fake path:", fake_path)
-            try:
-                print('Actual:   ', 'S' + acid_state[1])
-            except IndexError:
-                print('Actual path not given.')
-
-            print("Probability Viterbi", probability_of_viterbi_decoded_state_path)
-            # probability_eval = my_HMM.evaluate(viterbi_decoded_state_path)
-            # print('Evaluate probability:', probability_eval)
-            probability_fake_path = my_HMM.evaluate(fake_path)
-            print('Probability non-membrane:', probability_fake_path)
-            print('Odds ratio:', math.exp(probability_of_viterbi_decoded_state_path - probability_fake_path))
-            print("")
+        if "ECOLI" in annotation:  # drop this test to decode every record (question 2i)
+            records.append((annotation, acid, labels))
+
+    # Decode all of the selected records in one go with the batched engine, rather than one HMM at a time
+    decoder = Chris_FastHMM.load_compiled_model()  # built once, however many records we decode
+    cache = Chris_DecodeCache.DecodeCache(decoder)  # duplicate sequences are only decoded once
+    decoded = cache.decode_many([acid for annotation, acid, labels in records])
+
+    # Score every all-I fake path in a single pass too
+    fake_paths = ['S' + 'I' * (len(acid) - 1) for annotation, acid, labels in records]
+    fake_path_scores = decoder.score_pairs([acid for annotation, acid, labels in records], fake_paths)[0]
+
+    for (annotation, acid, labels), (probability_of_viterbi_decoded_state_path, viterbi_decoded_state_path), \
+            fake_path, probability_fake_path in zip(records, decoded, fake_paths, fake_path_scores):
+        print(">" + annotation)
+        print('Sequence: ', acid)
+        # state_path = ''.join(viterbi_decoded_state_path)
+        # print("         ", state_path)
+        print('Viterbi:  ', ''.join(viterbi_decoded_state_path))
+        print("Fake path:", fake_path)
+        if labels is not None:
+            print('Actual:   ', 'S' + labels)
+        else:
+            print('Actual path not given.')
+
+        print("Probability Viterbi", probability_of_viterbi_decoded_state_path)
+        print('Probability non-membrane:', probability_fake_path)
+        print('Odds ratio:', math.exp(probability_of_viterbi_decoded_state_path - probability_fake_path))
+        # The forward likelihood sums over all paths, so it is a better basis for classification than the Viterbi path
+        probability_forward = decoder.forward(acid)[0]
+        print('Probability forward:', probability_forward)
+        print('Forward log-odds:', probability_forward - probability_fake_path)
+        print("")
+
+    print('Decode cache:', cache.stats())
 
 # compare evaluate and end max viterbi value from viterbi program
-# estimate how good, forward viterbi sum instead of max
 # print(math.exp(-1001.2784709812921--1026.6084269854787))
@@ -0,0 +1,141 @@
+"""Chris_ModelFile
+A versioned binary file format for compiled TMM models, as a replacement for unpickling acid_dict (and log-transforming
+it) every time a decoder starts up.
+
+A .tmm file is a Chris_BinaryFormat container:
+
+    magic       8 bytes     b'TMMHMM\\x00\\x01'
+    version     uint32      little-endian, currently 2
+    header_len  uint32      little-endian, length in bytes of the JSON header that follows
+    header      JSON        states, alphabet, start state, array shapes / offsets, the SHA-256 of the array data and the
+                            model's fingerprint
+    padding                 zero bytes up to the next multiple of 64
+    arrays                  log_transitions then log_emissions, each aligned to 64 bytes, little-endian float64,
+                            C order, already log-transformed
+
+Because the arrays are stored exactly as CompiledHMM uses them, loading is just a memory map: many decoding worker
+processes can map the same file read-only and share its pages. Nothing in the file is executed, unlike a pickle, and the
+header, the array shapes and offsets (against the size of the file) and the checksum are all checked before the model
+is handed out. Files are written under a temporary name and renamed into place, so a reader never sees half of one.
+"""
+
+__author__ = 'Wombat'
+
+from hashlib import sha256
+from pickle import load
+import numpy as np
+import TMM_HMM_dicts
+import Chris_BinaryFormat
+import Chris_FastHMM
+
+SUFFIX = '.tmm'
+MAGIC = b'TMMHMM\x00\x01'
+VERSION = 2                 # version 1 packed log_emissions straight after log_transitions, without aligning it
+DTYPE = '<f8'
+ARRAYS = (('log_transitions', np.dtype(DTYPE)), ('log_emissions', np.dtype(DTYPE)))
+
+
+class ModelFileError(Chris_BinaryFormat.BinaryFormatError):
+
+    """Raised when a model artifact is malformed, of an unknown version, or fails validation"""
+
+
+def _checksum(arrays):
+
+    """The SHA-256 of the arrays' data, in layout order"""
+
+    digest = sha256()
+    for name, dtype in ARRAYS:
+        digest.update(np.ascontiguousarray(arrays[name], dtype=dtype))
+    return digest.hexdigest()
+
+
+def save_model_artifact(model, file_path):
+
+    """Write a CompiledHMM to file_path in the .tmm format"""
+
+    arrays = {'log_transitions': model.log_transitions, 'log_emissions': model.log_emissions}
+    header = {
+        'states': list(model.states),
+        'alphabet': list(model.alphabet),
+        'start_state': model.states[model.start],
+        'dtype': DTYPE,
+        'payload_sha256': _checksum(arrays),
+        'fingerprint': model.fingerprint(),
+    }
+    Chris_BinaryFormat.write_arrays(file_path, MAGIC, VERSION, header, arrays, ARRAYS)
+
+    print("We have written the model artifact to file", file_path)
+
+
+def read_header(file_path):
+
+    """Read and check the fixed preamble and JSON header of a .tmm file. Returns (header, array_section_offset)."""
+
+    return Chris_BinaryFormat.read_preamble(file_path, MAGIC, VERSION, ModelFileError, 'TMM model artifact')
+
+
+class ModelArtifact(Chris_BinaryFormat.ArrayFile):
+    """ModelArtifact
+    Read-only, memory-mapped access to the arrays of a .tmm file; load_model_artifact turns one into a CompiledHMM.
+    """
+
+    MAGIC = MAGIC
+    VERSION = VERSION
+    LAYOUT = ARRAYS
+    ERROR = ModelFileError
+    KIND = 'TMM model artifact'
+
+
+def load_model_artifact(file_path, verify=True):
+
+    """Memory-map a .tmm file as a read-only CompiledHMM. With verify (the default) the checksum and the fingerprint
+    are recomputed, which reads the whole of both arrays once; the header, shape, offset and alphabet checks are always
+    done.
+    """
+
+    artifact = ModelArtifact(file_path)
+    header, arrays = artifact.header, artifact.arrays
+
+    try:
+        states = header['states']
+        alphabet = header['alphabet']
+        number_of_states = len(states)
+        if header['dtype'] != DTYPE:
+            raise ModelFileError('{} stores {} arrays, expected {}'.format(file_path, header['dtype'], DTYPE))
+    except (KeyError, TypeError) as error:
+        raise ModelFileError('{} has an incomplete header: {!r}'.format(file_path, error))
+
+    if len(set(states)) != number_of_states or header.get('start_state') not in states:
+        raise ModelFileError('{} has an invalid state list'.format(file_path))
+    if len(set(alphabet)) != len(alphabet) or not all(isinstance(symbol, str) and len(symbol) == 1
+                                                      for symbol in alphabet):
+        raise ModelFileError('{} has an invalid alphabet'.format(file_path))
+    if arrays['log_transitions'].shape != (number_of_states, number_of_states) or \
+            arrays['log_emissions'].shape != (number_of_states, len(alphabet) + 1):
+        raise ModelFileError('{} has array shapes that do not match its states and alphabet'.format(file_path))
+
+    if verify and _checksum(arrays) != header.get('payload_sha256'):
+        raise ModelFileError('{} failed its checksum'.format(file_path))
+
+    model = Chris_FastHMM.CompiledHMM.from_arrays(states, alphabet, arrays['log_transitions'],
+                                                  arrays['log_emissions'], header['start_state'])
+    if verify and model.fingerprint() != header.get('fingerprint'):
+        raise ModelFileError('{} does not rebuild the model it was written from'.format(file_path))
+
+    return model
+
+
+def main(pickle_path='acid_dict', artifact_path='acid_dict' + SUFFIX):
+
+    """Convert the pickled transition dict plus TMM_HMM_dicts.emissions into a binary model artifact"""
+
+    with open(pickle_path, 'rb') as f:
+        transitions = load(f)
+    model = Chris_FastHMM.CompiledHMM.from_probabilities(transitions, TMM_HMM_dicts.emissions)
+    save_model_artifact(model, artifact_path)
+    print(load_model_artifact(artifact_path).fingerprint() == model.fingerprint())
+
+
+if __name__ == '__main__':
+    main()
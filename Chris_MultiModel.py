@@ -0,0 +1,162 @@
+__author__ = 'Wombat'
+
+from time import perf_counter
+import numpy as np
+import Chris_FastHMM
+from Chris_FastHMM import CompiledHMM, log_sum_exp
+from Chris_HigherOrderHMM import HigherOrderHMM
+from Chris_MakeMarkov_TMM import Hamlet
+from FastA_V2 import AnnotatedFastA
+
+
+def null_model(model, null_state='I'):
+
+    """The "fake path" model of the Chris_MiniHMM.py driver as a model of its own: a copy of model that keeps only the
+    start -> null_state and null_state -> null_state transitions (with their original probabilities, not renormalized),
+    so that its Viterbi score for a sequence is exactly the score of the all-null_state path the driver compares to.
+    """
+
+    keep = np.full(model.log_transitions.shape, False)
+    null = model.state_index[null_state]
+    keep[model.start, null] = keep[null, null] = True
+    return model.with_tables(np.where(keep, model.log_transitions, -np.inf), model.log_emissions, model.dtype)
+
+
+class ModelStack(object):
+    """ModelStack
+    Scores sequences against several CompiledHMMs at once (say the TMM model, a non-membrane null model and some
+    alternative topologies), so that classifying a proteome takes one pass over the data rather than one per model.
+
+    The models' tables are padded out to the largest state count and stacked:
+
+        log_transitions[m, k, l]    model m's log P(state l | state k), -inf for padding states
+        log_emissions[m, l, c]      model m's log P(symbol c | state l), over the union of all the models' alphabets
+
+    Every recursion step then updates a (sequences x models x states) array, so all the sequences of a length bucket
+    (see CompiledHMM.viterbi_batch) are scored against all of the models with the same handful of numpy operations.
+    Padding states can never be entered, so they change no model's score.
+    """
+
+    def __init__(self, models, names=None):
+
+        self.models = list(models)
+        self.names = list(names) if names else ['model_{}'.format(i) for i in range(len(self.models))]
+        if len(self.names) != len(self.models):
+            raise ValueError('Got {} names for {} models'.format(len(self.names), len(self.models)))
+
+        self.alphabet = sorted({symbol for model in self.models for symbol in model.alphabet})
+        self.unknown_symbol = len(self.alphabet)
+        self.lookup = np.full(256, self.unknown_symbol, dtype=np.intp)
+        for i, symbol in enumerate(self.alphabet):
+            self.lookup[ord(symbol)] = i
+
+        number_of_models = len(self.models)
+        number_of_states = max(len(model.states) for model in self.models)
+        self.log_transitions = np.full((number_of_models, number_of_states, number_of_states), -np.inf)
+        self.log_emissions = np.full((number_of_models, number_of_states, len(self.alphabet) + 1), -np.inf)
+        self.starts = np.array([model.start for model in self.models], dtype=np.intp)
+
+        for m, model in enumerate(self.models):
+            n = len(model.states)
+            # Map every union symbol onto this model's own column (its catch-all if it has never heard of the symbol)
+            columns = [model.symbol_index.get(symbol, model.unknown_symbol) for symbol in self.alphabet]
+            self.log_emissions[m, :n] = model.log_emissions[:, columns + [model.unknown_symbol]]
+            self.log_transitions[m, :n, :n] = model.log_transitions
+        self.transitions = np.exp(self.log_transitions)
+
+    def encode(self, sequence):
+
+        return self.lookup[np.frombuffer(sequence.upper().encode('latin-1'), dtype=np.uint8)]
+
+    def scores(self, sequences, mode='viterbi', bucket_width=32, max_batch_size=256):
+
+        """A (sequences x models) array of scores: every sequence's Viterbi log probability (mode='viterbi') or forward
+        log likelihood (mode='forward') under every model, each identical to what that model would give on its own.
+        """
+
+        if mode not in ('viterbi', 'forward'):
+            raise ValueError("mode must be 'viterbi' or 'forward', not {!r}".format(mode))
+
+        encoded = [self.encode(sequence) for sequence in sequences]
+        scores = np.zeros((len(encoded), len(self.models)))
+        for bucket in CompiledHMM._length_buckets([len(e) for e in encoded], bucket_width, max_batch_size):
+            scores[bucket] = self._score_bucket([encoded[i] for i in bucket], mode)
+        return scores
+
+    def _score_bucket(self, encoded_sequences, mode):
+
+        batch_size = len(encoded_sequences)
+        lengths = np.array([len(e) for e in encoded_sequences])
+        max_length = max(lengths.max(), 1)
+
+        padded = np.full((batch_size, max_length), self.unknown_symbol, dtype=np.intp)     # padding is masked off below
+        for row, e in enumerate(encoded_sequences):
+            padded[row, :len(e)] = e
+
+        columns = np.full((batch_size,) + self.log_transitions.shape[:2], -np.inf)     # (sequences, models, states)
+        columns[:, np.arange(len(self.models)), self.starts] = 0
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            for position in range(1, max_length):
+                emission_columns = self.log_emissions[:, :, padded[:, position]].transpose(2, 0, 1)
+                if mode == 'viterbi':
+                    new_columns = (columns[:, :, :, np.newaxis] + self.log_transitions).max(axis=2)
+                else:       # log-sum-exp over old states, as a max-shifted (batched) matrix-vector product
+                    peak = columns.max(axis=2, keepdims=True)
+                    peak = np.where(np.isfinite(peak), peak, 0)
+                    new_columns = np.log((np.exp(columns - peak)[:, :, np.newaxis, :] @ self.transitions)[:, :, 0]) + \
+                        peak
+                active = (position < lengths)[:, np.newaxis, np.newaxis]    # ended sequences keep their column
+                columns = np.where(active, new_columns + emission_columns, columns)
+
+        scores = columns.max(axis=2) if mode == 'viterbi' else log_sum_exp(columns, axis=2)
+        scores[lengths < 2] = 0         # a bare start column, as CompiledHMM.viterbi reports it
+        return scores
+
+    def rank(self, sequences, mode='viterbi', reference=None):
+
+        """Score sequences against every model and rank the models for each one. Returns (scores, log_odds, ranking):
+        scores as from scores(); log_odds, the same shape, is each model's score minus that of the reference model (by
+        name or index), or by default minus the best of the other models, so a positive entry means the model wins
+        and by how much; and ranking lists, for each sequence, the model names from best to worst.
+        """
+
+        scores = self.scores(sequences, mode)
+        if reference is not None:
+            reference = self.names.index(reference) if isinstance(reference, str) else reference
+            log_odds = scores - scores[:, [reference]]
+        elif len(self.models) > 1:
+            best_other = np.empty_like(scores)
+            for m in range(len(self.models)):
+                best_other[:, m] = np.delete(scores, m, axis=1).max(axis=1)
+            log_odds = scores - best_other
+        else:
+            log_odds = np.zeros_like(scores)
+
+        ranking = [[self.names[m] for m in order] for order in np.argsort(-scores, axis=1, kind='stable')]
+        return scores, log_odds, ranking
+
+
+def main(fasta_paths=('160_membrane_prots.txt', '645_non_membrane_prots.txt.fasta')):
+
+    """Classify every protein in the membrane and non-membrane sets in one pass against the TMM model, the all-I null
+    model and an order-2 TMM model, reporting how many of each set every model wins
+    """
+
+    tmm = Chris_FastHMM.load_compiled_model()
+    stack = ModelStack([tmm, null_model(tmm), HigherOrderHMM.from_hamlet(Hamlet("160_membrane_prots.txt", 2)).model],
+                       ['tmm', 'null', 'tmm_order_2'])
+
+    for fasta_path in fasta_paths:
+        sequences = ["_" + acid for annotation, acid, labels in AnnotatedFastA(fasta_path, strict=False)]
+        started = perf_counter()
+        scores, log_odds, ranking = stack.rank(sequences)
+        elapsed = perf_counter() - started
+
+        wins = {name: sum(order[0] == name for order in ranking) for name in stack.names}
+        print(fasta_path, len(sequences), 'sequences scored against', len(stack.models),
+              'models in {:.2f}s'.format(elapsed), 'wins:', wins)
+
+
+if __name__ == '__main__':
+    main()
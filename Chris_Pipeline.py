@@ -0,0 +1,130 @@
+__author__ = 'Wombat'
+
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from os import cpu_count
+import sys
+import Chris_FastHMM
+import Chris_TopologyStore
+import Chris_SharedBuffers
+from FastA_V2 import AnnotatedFastA
+
+
+def decode_chunk(model_path, records, as_segments=False):
+
+    """Decode a chunk of (annotation, sequence) records in a worker process. The model is loaded once per worker, and
+    the chunk goes through the batched Viterbi engine and one batched scoring pass. Returns a list of
+    (annotation, viterbi_score, log_odds, topology) tuples in the same order as records, where topology is the path as
+    a string, or with as_segments its run-length encoded (state, start, end) segments.
+    """
+
+    model = Chris_FastHMM.load_compiled_model(model_path)
+    acids = ['_' + sequence for annotation, sequence in records]
+    decoded = model.viterbi_batch(acids, as_segments=as_segments)
+    paths = [Chris_TopologyStore.expand_segments(path) if as_segments else path for score, path in decoded]
+    log_odds = model.score_pairs(acids, paths)[1]
+    return [(annotation, score, float(odds), path if as_segments else ''.join(path))
+            for (annotation, sequence), (score, path), odds in zip(records, decoded, log_odds)]
+
+
+def read_chunks(fasta_path, chunk_size):
+
+    """The producer: yield lists of up to chunk_size (annotation, sequence) records from a FastA file, with any '#'
+    topology annotation stripped off the sequence.
+    """
+
+    chunk = []
+    for annotation, acid, labels in AnnotatedFastA(fasta_path, strict=False):     # block reads, for big proteomes
+        chunk.append((annotation, acid))
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def decode_file(fasta_path, output=sys.stdout, workers=None, chunk_size=64, max_pending=None,
+                model_path='acid_dict', store_path=None, use_shared_memory=False):
+
+    """Decode every record of a FastA file across a pool of worker processes, writing one tab-separated line per record
+    (annotation, Viterbi score, log-odds against the all-I fake path, topology) to output, in input order.
+
+    Records are read in chunks of chunk_size and each chunk is one task for the pool. At most max_pending chunks (by
+    default two per worker, so no worker sits idle waiting for the next one) are in flight at once: once the window is
+    full the producer stops reading and waits for the oldest chunk, writes its results, and only then reads on. This
+    keeps memory bounded no matter how big the file is, and writing strictly oldest-first keeps the output in order.
+
+    With store_path, the topologies are also written to a run-length encoded Chris_TopologyStore file, and the
+    topology column of the text output is given in its short run-length form (e.g. 'S1 I20 M23 O87') too.
+
+    With use_shared_memory, the model and each chunk's encoded sequences are put in shared memory (Chris_SharedBuffers)
+    and the workers write their results straight back into it, so nothing but block names and record ranges is ever
+    pickled between processes.
+
+    Returns the number of records decoded.
+    """
+
+    workers = workers or cpu_count() or 1
+    max_pending = max_pending or 2 * workers
+    pending = deque()
+    decoded = 0
+
+    model = Chris_FastHMM.load_compiled_model(model_path)
+    store = Chris_TopologyStore.TopologyStoreWriter(store_path, model.states) if store_path else None
+    shared_model = Chris_SharedBuffers.SharedModel(model) if use_shared_memory else None
+
+    def submit(pool, chunk):
+        if not shared_model:
+            future = pool.submit(decode_chunk, model_path, chunk, bool(store))
+            return future, future.result
+
+        batch = Chris_SharedBuffers.SharedSequenceBatch(model, ['_' + sequence for annotation, sequence in chunk])
+        future = pool.submit(Chris_SharedBuffers.decode_range, shared_model.descriptor, batch.descriptor, 0, len(chunk))
+
+        def collect():
+            future.result()
+            with batch:
+                results = batch.results(model.states)
+            return [(annotation, score, log_odds,
+                     Chris_TopologyStore.path_segments(path) if store else path)
+                    for (annotation, sequence), (score, log_odds, path) in zip(chunk, results)]
+
+        return future, collect
+
+    def write_oldest():
+        results = pending.popleft()[1]()
+        for annotation, score, log_odds, topology in results:
+            if store:
+                store.add(annotation, topology)
+                topology = Chris_TopologyStore.segments_to_string(topology)
+            print(annotation, score, log_odds, topology, sep='\t', file=output)
+        return len(results)
+
+    try:
+        with ProcessPoolExecutor(workers) as pool:
+            for chunk in read_chunks(fasta_path, chunk_size):
+                if len(pending) >= max_pending:     # backpressure: don't read ahead of the slowest chunk in the window
+                    decoded += write_oldest()
+                pending.append(submit(pool, chunk))
+
+            while pending:
+                decoded += write_oldest()
+    finally:
+        if shared_model:
+            shared_model.close()
+
+    if store:
+        store.close()
+
+    return decoded
+
+
+def main(fasta_path='645_non_membrane_prots.txt.fasta', output_path='645_non_membrane_prots.topology.tsv'):
+
+    with open(output_path, 'w') as output:
+        decoded = decode_file(fasta_path, output)
+    print('Decoded', decoded, 'records from', fasta_path, 'into', output_path)
+
+
+if __name__ == '__main__':
+    main()
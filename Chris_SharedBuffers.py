@@ -0,0 +1,187 @@
+"""Chris_SharedBuffers
+Shared-memory buffers that let a pool of worker processes decode without any model or sequence ever being pickled.
+
+    SharedModel          the compiled model's log tables, in one shared block
+    SharedSequenceBatch  a batch of alphabet-encoded sequences, plus room for the decoded paths, Viterbi scores and
+                         log-odds to be written straight back into the same block
+
+Only the small descriptor tuples (a block name plus a few counts) and (first, last) record ranges travel over the
+pool's queues; workers attach to the blocks and work on numpy views of them, zero-copy. Each block is owned by the
+process that created it, which must close() it (or use it as a context manager) to free it.
+"""
+
+__author__ = 'Wombat'
+
+from multiprocessing.shared_memory import SharedMemory
+import numpy as np
+import Chris_FastHMM
+
+ALIGNMENT = 64
+
+
+def _aligned(size):
+
+    return size + (-size % ALIGNMENT)
+
+
+def _attach(name):
+
+    """Attach to an existing shared block in a worker. Pool workers share their parent's resource tracker (under fork
+    and spawn alike), where the block is already registered to the creating process, so the worker must neither
+    unregister it nor unlink it: it only closes its own mapping.
+    """
+
+    try:
+        return SharedMemory(name=name, track=False)     # Python 3.13+
+    except TypeError:
+        return SharedMemory(name=name)
+
+
+class SharedModel(object):
+    """SharedModel
+    A CompiledHMM's log transition and emission tables copied once into shared memory. Pass descriptor to workers and
+    have them call attach_model(descriptor).
+    """
+
+    def __init__(self, model):
+
+        transitions_size = _aligned(model.log_transitions.nbytes)
+        self.block = SharedMemory(create=True, size=max(1, transitions_size + model.log_emissions.nbytes))
+        self.descriptor = (self.block.name, tuple(model.states), tuple(model.alphabet), model.states[model.start],
+                           model.log_transitions.shape, model.log_emissions.shape, transitions_size)
+
+        log_transitions, log_emissions = _model_views(self.block, self.descriptor)
+        log_transitions[:] = model.log_transitions
+        log_emissions[:] = model.log_emissions
+
+    def close(self):
+
+        self.block.close()
+        self.block.unlink()
+
+    def __enter__(self):
+
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+
+        self.close()
+
+
+def _model_views(block, descriptor):
+
+    name, states, alphabet, start_state, transitions_shape, emissions_shape, emissions_offset = descriptor
+    log_transitions = np.ndarray(transitions_shape, dtype=np.float64, buffer=block.buf)
+    log_emissions = np.ndarray(emissions_shape, dtype=np.float64, buffer=block.buf, offset=emissions_offset)
+    return log_transitions, log_emissions
+
+
+_attached_models = {}   # block name -> (block, CompiledHMM), so each worker attaches to a given model only once
+
+
+def attach_model(descriptor):
+
+    """In a worker: the CompiledHMM whose tables live in the shared block described by descriptor"""
+
+    name, states, alphabet, start_state = descriptor[:4]
+    if name not in _attached_models:
+        block = _attach(name)
+        log_transitions, log_emissions = _model_views(block, descriptor)
+        log_transitions.setflags(write=False)
+        log_emissions.setflags(write=False)
+        model = Chris_FastHMM.CompiledHMM.from_arrays(states, alphabet, log_transitions, log_emissions, start_state)
+        _attached_models[name] = (block, model)     # keep the block open as long as the model is in use
+    return _attached_models[name][1]
+
+
+class SharedSequenceBatch(object):
+    """SharedSequenceBatch
+    A batch of sequences, alphabet-encoded as uint8 and laid end to end in one shared block, with an offsets array
+    (record i is symbols[offsets[i]:offsets[i + 1]]). The same block has a parallel uint8 array for the decoded state
+    paths and float64 arrays for the Viterbi scores and log-odds, which decode_range() fills in from the workers.
+    """
+
+    def __init__(self, model, sequences):
+
+        if len(model.alphabet) >= 255 or len(model.states) > 255:
+            raise ValueError('Shared sequence batches hold symbols and states as uint8')
+
+        encoded = [model.encode(sequence).astype(np.uint8) for sequence in sequences]
+        count = len(encoded)
+        total = sum(len(e) for e in encoded)
+
+        self.layout = {}
+        offset = 0
+        for name, dtype, length in (('offsets', np.int64, count + 1), ('symbols', np.uint8, total),
+                                    ('paths', np.uint8, total), ('scores', np.float64, count),
+                                    ('log_odds', np.float64, count)):
+            self.layout[name] = (offset, np.dtype(dtype).str, length)
+            offset += _aligned(np.dtype(dtype).itemsize * length)
+
+        self.block = SharedMemory(create=True, size=max(1, offset))
+        self.descriptor = (self.block.name, self.layout)
+        self.views = _batch_views(self.block, self.layout)
+
+        self.views['offsets'][:] = np.concatenate(([0], np.cumsum([len(e) for e in encoded])))
+        if total:
+            self.views['symbols'][:] = np.concatenate(encoded)
+
+    def __len__(self):
+
+        return len(self.views['scores'])
+
+    def results(self, states):
+
+        """After decoding: a list of (viterbi_score, log_odds, path) with path as a string of state names"""
+
+        offsets = self.views['offsets']
+        return [(float(self.views['scores'][i]), float(self.views['log_odds'][i]),
+                 ''.join(states[s] for s in self.views['paths'][offsets[i]:offsets[i + 1]].tolist()))
+                for i in range(len(self))]
+
+    def close(self):
+
+        self.views = None       # the views must go before the block's memory can be released
+        self.block.close()
+        self.block.unlink()
+
+    def __enter__(self):
+
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+
+        self.close()
+
+
+def _batch_views(block, layout):
+
+    return {name: np.ndarray((length,), dtype=dtype, buffer=block.buf, offset=offset)
+            for name, (offset, dtype, length) in layout.items()}
+
+
+def decode_range(model_descriptor, batch_descriptor, first, last):
+
+    """In a worker: decode records first .. last - 1 of a shared batch, writing paths, scores and log-odds (against the
+    all-I fake path) straight back into the batch. Returns the number of records decoded.
+    """
+
+    model = attach_model(model_descriptor)
+    name, layout = batch_descriptor
+    block = _attach(name)
+    try:
+        views = _batch_views(block, layout)
+        offsets = views['offsets']
+        sequences = [views['symbols'][offsets[i]:offsets[i + 1]] for i in range(first, last)]
+
+        decoded = model.viterbi_batch(sequences)
+        paths = [model.encode_path(path) for score, path in decoded]
+        views['log_odds'][first:last] = model.score_pairs(sequences, paths)[1]
+        for i, (score, path), path_indices in zip(range(first, last), decoded, paths):
+            views['scores'][i] = score
+            views['paths'][offsets[i]:offsets[i + 1]] = path_indices
+        del views, offsets, sequences       # every view of the block must be gone before it can be closed
+    finally:
+        block.close()
+
+    return last - first
@@ -0,0 +1,177 @@
+"""Chris_TopologyStore
+A compact binary store of run-length encoded topologies, indexed by sequence id.
+
+A topology like SIIIIMMMMMMMMMMMMMMMMMMMMOOOO... is stored as its segments, (state, start, end) with the usual Python
+half-open positions, which for a membrane protein is a handful of segments instead of hundreds of characters. Layout of
+a .topo file:
+
+    magic       8 bytes     b'TMMTOPO\\x01'
+    version     uint32      little-endian, currently 1
+    header_len  uint32      little-endian, length in bytes of the JSON header that follows
+    header      JSON        states, record and segment counts, and the offset of each array below
+    arrays      (each aligned to 64 bytes, see Chris_BinaryFormat)
+        segments        (state uint8, start uint32, end uint32) records, packed, for every record in turn
+        record_offsets  int64, record i owns segments[record_offsets[i]:record_offsets[i + 1]]
+        state_counts    uint32 (records x states), how many segments of each state each record has
+        id_offsets      int64, record i's id is id_blob[id_offsets[i]:id_offsets[i + 1]]
+        id_blob         the UTF-8 ids, concatenated
+
+Everything is memory-mapped on reading, and because the per-record segment counts are precomputed, queries such as
+"all proteins with at least 7 M segments" are a single vectorized comparison over one column.
+"""
+
+__author__ = 'Wombat'
+
+from itertools import groupby
+import numpy as np
+import Chris_BinaryFormat
+
+MAGIC = b'TMMTOPO\x01'
+VERSION = 1
+SEGMENT_DTYPE = np.dtype([('state', 'u1'), ('start', '<u4'), ('end', '<u4')])
+ARRAYS = (('segments', SEGMENT_DTYPE), ('record_offsets', np.dtype('<i8')), ('state_counts', np.dtype('<u4')),
+          ('id_offsets', np.dtype('<i8')), ('id_blob', np.dtype('u1')))
+
+
+def path_segments(path):
+
+    """Run-length encode a path given as a string (e.g. a '#' topology annotation) or a list of state names, as a list
+    of (state, start, end) segments.
+    """
+
+    segments = []
+    start = 0
+    for state, run in groupby(path):
+        end = start + sum(1 for _ in run)
+        segments.append((state, start, end))
+        start = end
+    return segments
+
+
+def segments_to_string(segments):
+
+    """A short text form of a run-length encoded path, e.g. 'S1 I20 M23 O87'"""
+
+    return ' '.join('{}{}'.format(state, end - start) for state, start, end in segments)
+
+
+def expand_segments(segments):
+
+    """The inverse of path_segments: the per-residue path as a string"""
+
+    return ''.join(state * (end - start) for state, start, end in segments)
+
+
+class TopologyStoreError(Chris_BinaryFormat.BinaryFormatError):
+
+    """Raised when a topology store file is malformed, truncated or of an unknown version"""
+
+
+class TopologyStoreWriter(object):
+    """TopologyStoreWriter
+    Collects (id, segments) records and writes them out as a .topo file on close(). Use it as a context manager:
+
+        with TopologyStoreWriter('proteome.topo', model.states) as store:
+            store.add(annotation, model.viterbi(sequence, as_segments=True)[1])
+    """
+
+    def __init__(self, file_path, states):
+
+        self.file_path = file_path
+        self.states = list(states)
+        self.state_index = {state: i for i, state in enumerate(self.states)}
+        if len(self.states) > 255:
+            raise TopologyStoreError('A topology store holds at most 255 states')
+
+        self.ids = []
+        self.segments = []      # one (n, 3) array per record
+        self.state_counts = []
+
+    def add(self, sequence_id, segments):
+
+        encoded = np.array([(self.state_index[state], start, end) for state, start, end in segments],
+                           dtype=np.int64).reshape(-1, 3)
+        self.ids.append(sequence_id)
+        self.segments.append(encoded)
+        self.state_counts.append(np.bincount(encoded[:, 0], minlength=len(self.states)))
+
+    def close(self):
+
+        segments = np.concatenate(self.segments) if self.segments else np.zeros((0, 3), dtype=np.int64)
+        packed = np.empty(len(segments), dtype=SEGMENT_DTYPE)
+        packed['state'], packed['start'], packed['end'] = segments[:, 0], segments[:, 1], segments[:, 2]
+
+        arrays = {
+            'segments': packed,
+            'record_offsets': np.concatenate(([0], np.cumsum([len(s) for s in self.segments]))).astype('<i8'),
+            'state_counts': np.array(self.state_counts, dtype='<u4').reshape(len(self.ids), len(self.states)),
+        }
+        arrays.update(Chris_BinaryFormat.id_arrays(self.ids))
+
+        header = {'states': self.states, 'records': len(self.ids), 'segments': len(packed)}
+        Chris_BinaryFormat.write_arrays(self.file_path, MAGIC, VERSION, header, arrays, ARRAYS)
+
+    def __enter__(self):
+
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+
+        if exc_type is None:
+            self.close()
+
+
+class TopologyStore(Chris_BinaryFormat.ArrayFile):
+    """TopologyStore
+    Read-only, memory-mapped access to a .topo file written by TopologyStoreWriter.
+    """
+
+    MAGIC = MAGIC
+    VERSION = VERSION
+    LAYOUT = ARRAYS
+    ERROR = TopologyStoreError
+    KIND = 'topology store'
+
+    def __init__(self, file_path):
+
+        super().__init__(file_path)
+        try:
+            self.states = self.header['states']
+            self.state_index = {state: i for i, state in enumerate(self.states)}
+        except (KeyError, TypeError) as error:
+            raise TopologyStoreError('{} has an incomplete header: {!r}'.format(file_path, error))
+
+        self._id_index = None       # id -> record number, built on first lookup by id
+
+    def __len__(self):
+
+        return len(self.arrays['record_offsets']) - 1
+
+    def segments(self, record):
+
+        """The segments of a record, given either its id or its record number"""
+
+        if isinstance(record, str):
+            if self._id_index is None:
+                self._id_index = {sequence_id: i for i, sequence_id in enumerate(self.ids())}
+            record = self._id_index[record]
+
+        start, end = self.arrays['record_offsets'][record:record + 2]
+        return [(self.states[state], int(segment_start), int(segment_end))
+                for state, segment_start, segment_end in self.arrays['segments'][start:end].tolist()]
+
+    def segment_counts(self, state):
+
+        """An array with the number of state segments in every record"""
+
+        return self.arrays['state_counts'][:, self.state_index[state]]
+
+    def query(self, state, min_segments=1, max_segments=None):
+
+        """The ids of every record with at least min_segments (and at most max_segments) segments of state"""
+
+        counts = self.segment_counts(state)
+        selected = counts >= min_segments
+        if max_segments is not None:
+            selected &= counts <= max_segments
+        return [self.id(record) for record in np.flatnonzero(selected)]
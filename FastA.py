@@ -9,7 +9,7 @@ def Read_FastA_sequences(path):
     headers = []
 
     header = None
-    sequence = ''
+    sequence = []       # the lines of the current sequence, joined once when it is complete
 
     print('Opening', path)
 
@@ -25,23 +25,22 @@ def Read_FastA_sequences(path):
 
                 if header:
                     headers.append(header)
-                    sequences.append(sequence)
+                    sequences.append(''.join(sequence).translate(translation_table).upper())
 
                 header = line[1:]
-                sequence = ''
+                sequence = []
 
             else:
-                line = line.translate(translation_table)
-                sequence += line.upper()
+                sequence.append(line)
 
             line = f.readline()
 
         if header:  # Mop up the last sequence
 
             headers.append(header)
-            sequences.append(sequence)
+            sequences.append(''.join(sequence).translate(translation_table).upper())
 
-    print(sequences)
+    print('Read', len(sequences), 'sequences')
     return headers, sequences
 
 
@@ -0,0 +1,275 @@
+__author__ = 'Wombat'
+
+import mmap
+import os
+import numpy as np
+from FastA_V2 import AnnotatedFastA, FastA, split_annotation
+
+INDEX_SUFFIX = '.fidx'
+INDEX_VERSION = 2
+
+
+class FastAIndexError(ValueError):
+
+    """Raised when a record asked for is not in the file"""
+
+
+def build_index(fasta_path, index_path=None):
+
+    """Scan a FastA file once and write a sidecar index (fasta_path + '.fidx' by default) with one tab-separated line
+    per record, in file order:
+
+        header  offset  byte_length  residues  line_bases  line_width  annotated_residues
+
+    offset and byte_length locate the record's sequence lines in the file (everything between its header line and the
+    next header), and residues is the length of the sequence FastA_V2.FastA would give for it. line_bases and
+    line_width (residues per full line, and bytes per full line counting the newline) are filled in for "regular"
+    records, whose lines are all the same length apart from the last and hold nothing but upper case residues; any
+    byte of those can then be found by arithmetic alone. Records with lower case, spaces, digits, '#' annotations or
+    ragged lines get 0 / 0, and are cleaned up when read instead. annotated_residues is the length of the sequence
+    alone, before any '#', as FastA_V2.AnnotatedFastA would give it. The first line records the size and modification
+    time of the FastA file, so a stale index is noticed. Returns the index path.
+    """
+
+    index_path = index_path or fasta_path + INDEX_SUFFIX
+    stat = os.stat(fasta_path)
+
+    if stat.st_size:
+        with open(fasta_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+            entries = _scan(buffer)
+    else:
+        entries = []            # an empty file can't be memory-mapped, and has no records anyway
+
+    with open(index_path, 'w') as f:
+        f.write('#fidx\t{}\t{}\t{}\n'.format(INDEX_VERSION, stat.st_size, stat.st_mtime_ns))
+        for entry in entries:
+            f.write('\t'.join(str(field) for field in entry) + '\n')
+
+    return index_path
+
+
+def _scan(buffer):
+
+    """The index entries of a whole (memory-mapped) FastA file, hopping from header to header with find()"""
+
+    entries = []
+    start = 0 if buffer[:1] == b'>' else buffer.find(b'\n>')
+    if start > 0:
+        start += 1              # text before the first header is skipped, as FastA_V2 does in chunked mode
+
+    while start >= 0:
+        header_end = buffer.find(b'\n', start)
+        if header_end < 0:
+            header_end = len(buffer)
+        next_start = buffer.find(b'\n>', header_end)
+        end = len(buffer) if next_start < 0 else next_start + 1
+
+        body = buffer[header_end + 1:end]
+        residues = len(body.translate(FastA.block_table, FastA.block_deletions))
+        annotated_residues = len(body.partition(b'#')[0].translate(FastA.block_table, FastA.block_deletions))
+        entries.append((buffer[start + 1:header_end].strip().decode('latin-1'), header_end + 1, len(body), residues) +
+                       _line_layout(body, residues) + (annotated_residues,))
+        start = -1 if next_start < 0 else end
+
+    return entries
+
+
+def _line_layout(body, residues):
+
+    """(line_bases, line_width) for a regular record body, or (0, 0)"""
+
+    lines = body.split(b'\n')
+    if lines and not lines[-1]:
+        lines.pop()             # the newline that ends the last line
+    if not lines or b'\r' in body or b'#' in body or sum(len(line) for line in lines) != residues or \
+            body != body.upper():
+        return 0, 0             # Windows line ends, an annotation, lower case, or something else besides residues
+    if any(len(line) != len(lines[0]) for line in lines[:-1]) or len(lines[-1]) > len(lines[0]):
+        return 0, 0
+    return len(lines[0]), len(lines[0]) + 1
+
+
+class IndexedFastA(object):
+    """IndexedFastA
+    Random access to the records of a FastA file through its sidecar index (built by build_index, and rebuilt here if
+    it is missing or older than the file). The file is memory-mapped, so fetching a record costs a lookup and a slice
+    rather than a scan from the top, however big the file is.
+
+        fasta = IndexedFastA('645_non_membrane_prots.txt.fasta')
+        fasta['1AKO._ NUCLEASE']        # the whole sequence, by header...
+        fasta[1]                        # ...or by ordinal
+        fasta.fetch(1, 10, 20)          # residues 10 .. 19 only
+        fasta.residues(1, 10, 20)       # the same as a uint8 array, a view of the file itself where possible
+
+    Sequences come back exactly as FastA_V2.FastA(chunked=True) gives them: upper case, and for a file with '#'
+    topology annotations (like 160_membrane_prots.txt) that means sequence + '#' + labels as one string. With
+    annotated=True they come back as FastA_V2.AnnotatedFastA gives them instead: fetch() and residues() cover the
+    sequence alone, labels() gives the annotation (None if there is none) and iteration yields (header, sequence,
+    labels) tuples. strict is as for AnnotatedFastA, and applies to labels().
+    """
+
+    def __init__(self, fasta_path, index_path=None, annotated=False, strict=True):
+
+        self.fasta_path = fasta_path
+        self.annotated = annotated
+        self.strict = strict
+        self.index_path = index_path or fasta_path + INDEX_SUFFIX
+        if not self._index_is_current():
+            build_index(fasta_path, self.index_path)
+
+        self.headers = []
+        self.entries = []
+        with open(self.index_path) as f:
+            f.readline()
+            for line in f:
+                header, *fields = line.rstrip('\n').split('\t')
+                self.headers.append(header)
+                self.entries.append(tuple(int(field) for field in fields))
+        self.ordinals = {}
+        for ordinal, header in enumerate(self.headers):
+            self.ordinals.setdefault(header, ordinal)       # the first of any duplicate headers wins
+
+        self.file_handle = open(fasta_path, 'rb')
+        self.buffer = mmap.mmap(self.file_handle.fileno(), 0, access=mmap.ACCESS_READ) if self.entries else b''
+        self.data = np.frombuffer(self.buffer, dtype=np.uint8) if self.entries else np.zeros(0, dtype=np.uint8)
+
+    def _index_is_current(self):
+
+        try:
+            with open(self.index_path) as f:
+                tag, version, size, mtime = f.readline().rstrip('\n').split('\t')
+        except (OSError, ValueError):
+            return False
+        stat = os.stat(self.fasta_path)
+        return tag == '#fidx' and int(version) == INDEX_VERSION and int(size) == stat.st_size and \
+            int(mtime) == stat.st_mtime_ns
+
+    def __len__(self):
+
+        return len(self.entries)
+
+    def __contains__(self, header):
+
+        return header in self.ordinals
+
+    def __getitem__(self, key):
+
+        return self.fetch(key)
+
+    def __iter__(self):
+
+        """(header, sequence) tuples in file order, as FastA_V2.FastA yields them, or with annotated=True (header,
+        sequence, labels) tuples, as FastA_V2.AnnotatedFastA does
+        """
+
+        for ordinal, header in enumerate(self.headers):
+            if self.annotated:
+                yield header, self.fetch(ordinal), self.labels(ordinal)
+            else:
+                yield header, self.fetch(ordinal)
+
+    def ordinal(self, key):
+
+        """The record number of key, which may be a header or already a record number"""
+
+        if isinstance(key, str):
+            try:
+                return self.ordinals[key]
+            except KeyError:
+                raise FastAIndexError('No record {!r} in {}'.format(key, self.fasta_path)) from None
+        if not -len(self.entries) <= key < len(self.entries):
+            raise FastAIndexError('{} has {} records, there is no record {}'.format(self.fasta_path, len(self), key))
+        return key % len(self.entries)
+
+    def length(self, key):
+
+        """The number of residues fetch(key) gives for the whole record"""
+
+        return self.entries[self.ordinal(key)][5 if self.annotated else 2]
+
+    def raw(self, key):
+
+        """The record's sequence lines exactly as they are in the file, as a zero-copy memoryview"""
+
+        offset, byte_length = self.entries[self.ordinal(key)][:2]
+        return memoryview(self.buffer)[offset:offset + byte_length]
+
+    def residues(self, key, start=0, end=None):
+
+        """Residues start .. end - 1 of a record as a uint8 array. When they all lie on one line of the file (always,
+        for a record written on a single line) this is a read-only view of the memory-mapped file, with no copy at all;
+        otherwise their byte positions are worked out arithmetically from the line layout and gathered in one step.
+        """
+
+        offset, byte_length, residues, line_bases, line_width, annotated_residues = self.entries[self.ordinal(key)]
+        start, end, step = slice(start, end).indices(annotated_residues if self.annotated else residues)
+        end = max(start, end)
+
+        if not line_bases:              # an irregular record: clean the whole thing up, as FastA_V2 would
+            body = self.buffer[offset:offset + byte_length]
+            if self.annotated:
+                body = body.partition(b'#')[0]
+            sequence = body.translate(FastA.block_table, FastA.block_deletions)
+            return np.frombuffer(sequence, dtype=np.uint8)[start:end]
+
+        first_line, last_line = start // line_bases, (end - 1) // line_bases
+        if first_line == last_line or end == start:
+            position = offset + first_line * line_width + start % line_bases
+            return self.data[position:position + end - start]
+
+        wanted = np.arange(start, end)
+        return self.data[offset + wanted // line_bases * line_width + wanted % line_bases]
+
+    def fetch(self, key, start=0, end=None):
+
+        """Residues start .. end - 1 (by default the whole sequence) of a record, by header or ordinal, as a string"""
+
+        return self.residues(key, start, end).tobytes().decode('latin-1')
+
+    def labels(self, key):
+
+        """The '#' topology annotation of a record, checked against its sequence as FastA_V2.AnnotatedFastA checks it,
+        or None if it has none
+        """
+
+        ordinal = self.ordinal(key)
+        offset, byte_length = self.entries[ordinal][:2]
+        return split_annotation(self.headers[ordinal], self.buffer[offset:offset + byte_length], self.strict)[2]
+
+    def close(self):
+
+        self.data = None                # the array view has to go before the map can be closed
+        if isinstance(self.buffer, mmap.mmap):
+            self.buffer.close()
+        self.file_handle.close()
+
+    def __enter__(self):
+
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+
+        self.close()
+
+
+def main():
+
+    """Index both protein sets, pull a few records back out by header and by ordinal, and check every record against
+    what FastA_V2 gives for it, both plain and annotated
+    """
+
+    for fasta_path in ('160_membrane_prots.txt', '645_non_membrane_prots.txt.fasta'):
+        print('Indexed', fasta_path, 'into', build_index(fasta_path))
+        with IndexedFastA(fasta_path) as fasta:
+            last = len(fasta) - 1
+            print(len(fasta), 'records; the last is', fasta.headers[last])
+            print(fasta.headers[0], fasta.fetch(fasta.headers[0], 0, 60))
+            print(fasta.headers[last], fasta.fetch(last, 0, 60))
+            plain_matches = list(fasta) == list(FastA(fasta_path, chunked=True))
+        with IndexedFastA(fasta_path, annotated=True, strict=False) as fasta:
+            annotated_matches = list(fasta) == list(AnnotatedFastA(fasta_path, strict=False))
+        print('Same records as FastA_V2.FastA:', plain_matches, ' as FastA_V2.AnnotatedFastA:', annotated_matches)
+
+
+if __name__ == '__main__':
+    main()
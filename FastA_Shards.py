@@ -0,0 +1,144 @@
+__author__ = 'Wombat'
+
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from os import cpu_count
+import mmap
+import os
+from FastA_V2 import clean_sequence, split_annotation
+
+
+def shard_ranges(fasta_path, shards):
+
+    """Cut a file into (start, end) byte ranges of roughly equal size. The cuts fall wherever they fall; each reader
+    snaps its own range to record boundaries (see read_shard), so no one has to scan the file to place them.
+    """
+
+    size = os.path.getsize(fasta_path)
+    shards = max(1, min(shards, size))
+    cuts = [size * i // shards for i in range(shards + 1)]
+    return list(zip(cuts[:-1], cuts[1:]))
+
+
+def snap(buffer, position):
+
+    """The first record start (a '>' at the beginning of a line) at or after position, or len(buffer) if none"""
+
+    if position <= 0:
+        if buffer[:1] == b'>':
+            return 0
+        position = 0
+    elif buffer[position - 1:position + 1] == b'\n>':
+        return position
+    found = buffer.find(b'\n>', position)
+    return len(buffer) if found < 0 else found + 1
+
+
+def read_shard(fasta_path, start, end, annotated=False, strict=True):
+
+    """Stream the (header, sequence) tuples of the records whose header starts in the byte range [start, end), exactly
+    as FastA_V2.FastA(chunked=True) would give them. A record that starts inside the range is read to its end, even
+    past end; one that started before the range belongs to the previous shard. So the shards of shard_ranges() between
+    them yield every record of the file exactly once, whatever the cuts.
+
+    With annotated, the records are (header, sequence, labels) tuples, split and validated as FastA_V2.AnnotatedFastA
+    does it.
+    """
+
+    if not os.path.getsize(fasta_path):
+        return
+    with open(fasta_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+        position = snap(buffer, start)
+        while position < min(end, len(buffer)):
+            header_end = buffer.find(b'\n', position)
+            if header_end < 0:
+                header_end = len(buffer)
+            next_position = snap(buffer, header_end)
+            header = buffer[position + 1:header_end].strip().decode('latin-1')
+            body = buffer[header_end + 1:next_position]
+            yield split_annotation(header, body, strict) if annotated else (header, clean_sequence(body))
+            position = next_position
+
+
+def _run_shard(fasta_path, start, end, annotated, strict, function, args):
+
+    return function(read_shard(fasta_path, start, end, annotated, strict), *args)
+
+
+class ShardedFastA(object):
+    """ShardedFastA
+    A FastA file split into byte-range shards that can be parsed independently, so that ingestion scales with cores.
+
+        sharded = ShardedFastA('645_non_membrane_prots.txt.fasta', shards=8)
+        for shard in range(len(sharded)):
+            for header, sequence in sharded.shard(shard):       # one shard's record stream
+                ...
+        results = sharded.map(count_residues)   # count_residues(records) on every shard, in parallel, in shard order
+        for header, sequence in sharded.records():      # every record, parsed in parallel, in file order
+            ...
+
+    The shards never overlap and never drop a record (see read_shard). With annotated, every record stream is of
+    (header, sequence, labels) tuples, as FastA_V2.AnnotatedFastA yields them, and strict is as it is there.
+    """
+
+    def __init__(self, fasta_path, shards=None, annotated=False, strict=True):
+
+        self.fasta_path = fasta_path
+        self.annotated = annotated
+        self.strict = strict
+        self.ranges = shard_ranges(fasta_path, shards or 4 * (cpu_count() or 1))
+
+    def __len__(self):
+
+        return len(self.ranges)
+
+    def shard(self, number):
+
+        start, end = self.ranges[number]
+        return read_shard(self.fasta_path, start, end, self.annotated, self.strict)
+
+    def map(self, function, *args, workers=None):
+
+        """Call function(records, *args) on every shard's record stream in a pool of worker processes, and return the
+        results as a list in shard order. function must be a module level function, so that it can be pickled.
+        """
+
+        return list(self.imap(function, *args, workers=workers))
+
+    def imap(self, function, *args, workers=None):
+
+        """Like map, but yield each result as soon as it and those of all the shards before it are in. Only about two
+        shards per worker are submitted ahead of the one being waited for, so at most that many results are held at
+        once, however many shards there are.
+        """
+
+        workers = workers or cpu_count() or 1
+        with ProcessPoolExecutor(workers) as pool:
+            futures = deque()
+            for start, end in self.ranges:
+                futures.append(pool.submit(_run_shard, self.fasta_path, start, end, self.annotated, self.strict,
+                                           function, args))
+                if len(futures) > 2 * workers:
+                    yield futures.popleft().result()
+            while futures:
+                yield futures.popleft().result()
+
+    def records(self, workers=None):
+
+        """Every record of the file, in file order, with the parsing done by the pool. Shards are streamed through
+        imap, so only a few shards' worth of records (see imap) are in memory at once, not the whole file.
+        """
+
+        for shard_records in self.imap(list, workers=workers):
+            yield from shard_records
+
+
+def main(fasta_path='645_non_membrane_prots.txt.fasta'):
+
+    sharded = ShardedFastA(fasta_path, shards=8)
+    counts = [len(records) for records in sharded.map(list)]
+    print(fasta_path, 'in', len(sharded), 'shards of', counts, 'records:', sum(counts), 'in all')
+
+
+if __name__ == '__main__':
+    main()
@@ -13,14 +13,29 @@ class FastA:
     (header, sequence) tuple in turn.  Probably this class could be improved by figuring out how to use the filehandle
     with a context manager -- right now the filehandle is used by multiple methods, so it's not clear to me how this
     might be accomplished.
+
+    With chunked=True the file is instead read in binary blocks of block_size bytes and cut into records with bytes
+    level searches for '\n>', so no Python code runs per line. Each record's sequence lines are cleaned up in one go: a
+    single bytes.translate uppercases them and deletes line breaks, digits, '*' and spaces, which is a single pass
+    however many lines the record has, instead of a readline, tell, strip, translate and string concatenation for every
+    line. This is the mode to use for big proteome files. It differs from the default mode in that spaces are removed
+    too (everything in this package strips them anyway), a header must start its line, and any text before the first
+    header is ignored. Iteration yields the same (header, sequence) tuples either way.
     """
 
     translation_table = str.maketrans('', '', '0123456789*')
 
-    def __init__(self, file_name):
+    # For the chunked mode: uppercase as a bytes -> bytes table, and the bytes to drop from sequence lines
+    block_table = bytes.maketrans(b'abcdefghijklmnopqrstuvwxyz', b'ABCDEFGHIJKLMNOPQRSTUVWXYZ')
+    block_deletions = b'0123456789* \t\r\n\v\f'
+
+    def __init__(self, file_name, chunked=False, block_size=1 << 20):
 
-        self.file_handle = open(file_name, 'r')
+        self.chunked = chunked
+        self.block_size = block_size
+        self.file_handle = open(file_name, 'rb' if chunked else 'r')
         self.header = ''
+        self.records = self._read_blocks() if chunked else None
 
     def __iter__(self):
 
@@ -42,6 +57,14 @@ class FastA:
         file (indeed, the filehandle object itself) will remain persistent so long as the FastA object exists.
         """
 
+        if self.chunked:
+            try:
+                return next(self.records)
+            except StopIteration:
+                self.file_handle.seek(0)        # reset to the beginning of the file for another possible iteration
+                self.records = self._read_blocks()
+                raise
+
         mode = 'scan'       # we always start off scanning for a new > character, indicating a new header
         sequence = ''       # We don't yet know what the sequence will be that we report back
         position = self.file_handle.tell()      # remember where we are in the file in case we need to rewind a line
@@ -68,11 +91,103 @@ class FastA:
             self.file_handle.seek(0)                # reset to the beginning of the file for another possible iteration
             raise StopIteration()
 
+    def _read_blocks(self):
+
+        """The chunked mode's record generator. Whatever follows the last '\n>' in the buffer may be an incomplete
+        record, so it is carried over to be completed by the next block.
+        """
+
+        buffer = b''
+        while True:
+            block = self.file_handle.read(self.block_size)
+            if block:
+                buffer += block
+                end = buffer.rfind(b'\n>')
+                if end < 0:
+                    continue
+                complete, buffer = buffer[:end], buffer[end + 1:]
+            else:
+                complete, buffer = buffer, b''
+
+            for i, record in enumerate(complete.split(b'\n>')):
+                if not i:                           # split() has eaten the '>' of every record but the first
+                    if not record.startswith(b'>'):
+                        continue                    # text before the first header
+                    record = record[1:]
+                header, newline, body = record.partition(b'\n')
+                self.header = '>' + header.strip().decode('latin-1')
+                yield self._record(self.header[1:], body)
+
+            if not block:
+                return
+
+    def _record(self, header, body):
+
+        return header, clean_sequence(body)
+
     def close(self):
 
         self.file_handle.close()
 
 
+class AnnotationError(ValueError):
+
+    """Raised for a '#'-annotated record whose labels don't match its sequence"""
+
+
+class AnnotatedFastA(FastA):
+
+    """
+    FastA files like 160_membrane_prots.txt carry a topology annotation after each sequence, separated by a '#':
+
+        >FTSH_ECOLI
+          MAKNLILWLVIAVVLMSVFQ ... # OOOOMMMMMMMMMMMMMMMIIII ...
+
+    Iterating over an AnnotatedFastA yields (header, sequence, labels) tuples, with labels None for a record that has no
+    annotation. The records are streamed lazily in chunked mode, and each one is split on the '#' as bytes, before
+    anything else is done to it, so the sequence and the labels are each cleaned up with a single translate and
+    nothing is copied twice. A record whose labels are not exactly as long as its sequence (or that has more than one
+    '#') raises AnnotationError, naming the record; with strict=False it is reported and yielded with labels None.
+    """
+
+    def __init__(self, file_name, strict=True, block_size=1 << 20):
+
+        super().__init__(file_name, chunked=True, block_size=block_size)
+        self.strict = strict
+
+    def _record(self, header, body):
+
+        return split_annotation(header, body, self.strict)
+
+
+def clean_sequence(body):
+
+    """Raw sequence lines, as bytes, as one sequence string: uppercased, without line breaks, digits, '*' or spaces"""
+
+    return body.translate(FastA.block_table, FastA.block_deletions).decode('latin-1')
+
+
+def split_annotation(header, body, strict=True):
+
+    """Split a record's raw sequence lines (bytes) on the '#', into (header, sequence, labels); see AnnotatedFastA"""
+
+    sequence, hash_mark, labels = body.partition(b'#')
+    sequence = clean_sequence(sequence)
+    if not hash_mark:
+        return header, sequence, None
+
+    labels = clean_sequence(labels)
+    if len(labels) != len(sequence) or '#' in labels:
+        message = '{}: sequence length {} but {} labels'.format(header, len(sequence), len(labels))
+        if '#' in labels:
+            message = '{}: more than one # annotation'.format(header)
+        if strict:
+            raise AnnotationError(message)
+        print('Ignoring the labels of', message)
+        labels = None
+    return header, sequence, labels
+
+
 def main():
 
     """
@@ -1,8 +1,11 @@
 from FastA_V2 import FastA
 from math import log
+import numpy as np
+import Chris_Corpus
 
 
-def Calculate_info_and_consensus(input_filepath='Chris_Gyrb_aligned.fa.txt', alphabet='ACDEFGHIKLMNPQRSTVWY', threshold = 4):
+def Calculate_info_and_consensus(input_filepath='Chris_Gyrb_aligned.fa.txt', alphabet='ACDEFGHIKLMNPQRSTVWY', threshold = 4,
+                                 use_corpus=False):
 
     gap = '-'                           # Gap characters will need to be treated specially
     consensus = []                      # The consensus sequence of the alignment will eventually be here
@@ -10,15 +13,26 @@ def Calculate_info_and_consensus(input_filepath='Chris_Gyrb_aligned.fa.txt', alp
     sequence_matrix = []                # A list of the sequences we'll be analyzing
     information = []                    # A position-by-position information value deduced from the alignment
 
-    sequences = FastA(input_filepath)   # Instantiate a FastA object that we can iterate across to grab sequences
+    if use_corpus:      # Use the cached, memory-mapped Chris_Corpus of the file, and count a whole column at a time
 
-    for annotation, sequence in sequences:      # Now actually grab the sequences
+        corpus = Chris_Corpus.load_corpus(input_filepath)
+        matrix = corpus.matrix()                # (sequences x columns), a view of the mapped file: no parsing at all
+        symbols = corpus.alphabet
+        alignment_length = matrix.shape[1]
+        column_counts = {symbol: (matrix == symbols.index(symbol)).sum(axis=0) if symbol in symbols
+                         else np.zeros(alignment_length, dtype=int) for symbol in alphabet + gap}
 
-        sequence_matrix.append(sequence)        # Stash them all in memory
+    else:
 
+        sequences = FastA(input_filepath)   # Instantiate a FastA object that we can iterate across to grab sequences
 
-    alignment_length = len(sequence_matrix[0])
-    # We're just assuming here that all the sequences are properly aligned and of the same length. No error-checking!
+        for annotation, sequence in sequences:      # Now actually grab the sequences
+
+            sequence_matrix.append(sequence)        # Stash them all in memory
+
+
+        alignment_length = len(sequence_matrix[0])
+        # We're just assuming here that the sequences are properly aligned and all the same length. No error-checking!
 
     for position in range(alignment_length):           # Analyze the alignment on a position-by-position basis
 
@@ -26,6 +40,12 @@ def Calculate_info_and_consensus(input_filepath='Chris_Gyrb_aligned.fa.txt', alp
         symbol_sums = 0                                       # A count of how often each non-gap symbol is encountered
         gap_count = 0                                         # A count of how often a gap symbol is encountered
 
+        if use_corpus:                                  # The whole column has already been counted
+
+            symbol_counts = {symbol: int(column_counts[symbol][position]) for symbol in alphabet}
+            symbol_sums = sum(symbol_counts.values())
+            gap_count = int(column_counts[gap][position])
+
         for sequence in sequence_matrix:                # At each position, we must consider each sequence in turn
                                                         # i.e. we are analyzing a column of the alignment
             current_symbol = sequence[position]         # what symbol are we looking at right now?